@@ -0,0 +1,290 @@
+'''
+Caché persistente de resultados de los filtros (NLM, NLM_CPP, anisotropico, watershed...).
+
+Ejemplo:
+    cache = CacheResultados('cache_filtros', limite_disco=2*1024**3)
+    NLM_cache = cache.envolver(NLM, version=2)
+    img_nlm = NLM_cache(imagen, img_padding, 3, 0.1) #La segunda vez se lee de disco.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+import numpy as np
+
+_FALLO = object() #Resultado de leer cuando no hay nada guardado (None puede ser un resultado).
+
+
+#HUELLA DE LOS ARGUMENTOS.
+def actualizar_huella(resumen, valor):
+    '''
+    Añade un valor (matriz, número, cadena, lista, tupla o diccionario) al resumen criptográfico. De las
+    matrices se usa el tipo, la dimensión y el contenido, así que dos copias de la misma imagen dan la
+    misma huella.
+    '''
+
+    if isinstance(valor, np.ndarray):
+        resumen.update(b'ndarray' + str(valor.dtype).encode() + str(valor.shape).encode())
+        resumen.update(np.ascontiguousarray(valor).view(np.uint8).data)
+    elif isinstance(valor, (list, tuple)):
+        resumen.update(type(valor).__name__.encode() + str(len(valor)).encode())
+        for elemento in valor:
+            actualizar_huella(resumen, elemento)
+    elif isinstance(valor, dict):
+        resumen.update(b'dict' + str(len(valor)).encode())
+        for clave in sorted(valor):
+            actualizar_huella(resumen, clave)
+            actualizar_huella(resumen, valor[clave])
+    else:
+        resumen.update(type(valor).__name__.encode() + repr(valor).encode())
+
+
+#TAMAÑO DE UNA ENTRADA.
+def tamano_entrada(ruta):
+    '''
+    Bytes que ocupan en disco los archivos de una entrada de la caché.
+    '''
+
+    return sum(os.path.getsize(os.path.join(ruta, nombre)) for nombre in os.listdir(ruta))
+
+
+#ESTRUCTURA DE UN RESULTADO.
+def aplanar_resultado(resultado, matrices):
+    '''
+    Guarda en la lista matrices todas las matrices del resultado y devuelve su estructura (para JSON):
+    el índice de cada matriz, None o {'tuple'/'list': [...]}. Si el resultado tiene algo que no sea
+    una matriz, None, una tupla o una lista, lanza TypeError.
+    '''
+
+    if resultado is None:
+        return None
+    if isinstance(resultado, np.ndarray):
+        matrices.append(resultado)
+        return len(matrices)-1
+    if isinstance(resultado, (tuple, list)):
+        return {type(resultado).__name__: [aplanar_resultado(parte, matrices) for parte in resultado]}
+    raise TypeError('Solo se guardan matrices, None, tuplas y listas.')
+
+
+def reconstruir_resultado(estructura, matrices):
+    '''
+    Operación inversa de aplanar_resultado.
+    '''
+
+    if estructura is None:
+        return None
+    if isinstance(estructura, int):
+        return matrices[estructura]
+    if 'tuple' in estructura:
+        return tuple(reconstruir_resultado(parte, matrices) for parte in estructura['tuple'])
+    return [reconstruir_resultado(parte, matrices) for parte in estructura['list']]
+
+
+#CACHÉ DE RESULTADOS.
+class CacheResultados:
+    '''
+    Caché de resultados en dos niveles: memoria (dentro del proceso) y disco (entre ejecuciones).
+
+    Parámetros:
+        directorio : carpeta donde se guardan los resultados (se crea si no existe).
+        limite_disco : bytes máximos en disco. Al superarlos se borran los resultados usados hace más tiempo.
+        limite_memoria : bytes máximos de resultados guardados en memoria.
+
+    Notas:
+        La clave de cada resultado es un resumen (BLAKE2b) del nombre y la versión de la función y de
+        todos sus argumentos, incluido el contenido de las matrices. Cada resultado se guarda en una
+        carpeta con un archivo .npy por matriz, que se lee como memmap (solo lectura), así que un
+        resultado grande no se carga entero hasta que se usa. Al leer una entrada se actualiza su
+        fecha, que es la que decide el orden de borrado (LRU). Solo se guardan resultados formados por
+        matrices, None, tuplas y listas (por ejemplo, los de NLM_y_CPP). Los resultados devueltos son de solo
+        lectura, porque se comparten entre llamadas. Varios procesos pueden usar la misma carpeta: cada
+        uno lee los resultados que guardan los demás y el límite de disco cuenta todas las entradas. Hay
+        que subir la versión al cambiar una función para no reutilizar resultados antiguos.
+    '''
+
+    def __init__(self, directorio, limite_disco=1024**3, limite_memoria=256*1024**2):
+        self.directorio = directorio
+        self.limite_disco = limite_disco
+        self.limite_memoria = limite_memoria
+        os.makedirs(directorio, exist_ok=True)
+
+        self._cerrojo = threading.Lock()
+        self._memoria = OrderedDict() #clave -> (resultado, bytes), del menos al más reciente.
+        self._bytes_memoria = 0
+        self._estadisticas = dict(aciertos_memoria=0, aciertos_disco=0, fallos=0, guardados=0, borrados=0)
+
+        self._disco = OrderedDict() #clave -> bytes, de la usada hace más tiempo a la más reciente.
+        self._bytes_disco = 0
+        self._escanear_disco()
+
+    def clave(self, nombre, version, args, kwargs):
+        '''
+        Clave de un resultado a partir de la función, su versión y sus argumentos.
+        '''
+
+        resumen = hashlib.blake2b(digest_size=20)
+        actualizar_huella(resumen, (nombre, version, tuple(args), dict(kwargs)))
+        return resumen.hexdigest()
+
+    def envolver(self, funcion, version=1, nombre=None):
+        '''
+        Devuelve la función con caché: si ya se calculó con los mismos argumentos se devuelve el resultado
+        guardado y, si no, se calcula y se guarda.
+        '''
+
+        if nombre is None:
+            nombre = getattr(funcion, '__module__', '') + '.' + getattr(funcion, '__name__', repr(funcion))
+
+        @wraps(funcion)
+        def funcion_cache(*args, **kwargs):
+            clave = self.clave(nombre, version, args, kwargs)
+            resultado = self.leer(clave, _FALLO)
+            if resultado is _FALLO:
+                resultado = funcion(*args, **kwargs)
+                resultado = self.guardar(clave, resultado)
+            return resultado
+
+        return funcion_cache
+
+    def leer(self, clave, defecto=None):
+        '''
+        Resultado guardado con esa clave (primero en memoria y después en disco) o defecto si no existe.
+        '''
+
+        with self._cerrojo:
+            if clave in self._memoria:
+                self._memoria.move_to_end(clave)
+                self._estadisticas['aciertos_memoria'] += 1
+                return self._memoria[clave][0]
+
+            ruta = os.path.join(self.directorio, clave)
+            try: #Puede haberla guardado o borrado otro proceso.
+                with open(os.path.join(ruta, 'info.json')) as archivo:
+                    info = json.load(archivo)
+                matrices = [np.load(os.path.join(ruta, str(k) + '.npy'), mmap_mode='r') for k in range(info['matrices'])]
+                os.utime(ruta) #Usada ahora (LRU).
+            except (OSError, ValueError):
+                if clave in self._disco:
+                    self._bytes_disco -= self._disco.pop(clave)
+                self._estadisticas['fallos'] += 1
+                return defecto
+            resultado = reconstruir_resultado(info['estructura'], matrices)
+
+            if clave not in self._disco: #Guardada por otro proceso.
+                self._disco[clave] = tamano_entrada(ruta)
+                self._bytes_disco += self._disco[clave]
+            self._disco.move_to_end(clave)
+            self._estadisticas['aciertos_disco'] += 1
+            self._guardar_memoria(clave, resultado, matrices)
+
+            return resultado
+
+    def guardar(self, clave, resultado):
+        '''
+        Guarda el resultado en memoria y en disco y lo devuelve (de solo lectura). Los resultados que no
+        se pueden guardar se devuelven tal cual.
+        '''
+
+        matrices = []
+        try:
+            estructura = aplanar_resultado(resultado, matrices)
+        except TypeError:
+            return resultado
+
+        matrices = [np.array(matriz, copy=True) for matriz in matrices] #Copias: quien llama puede seguir modificando las suyas.
+        for matriz in matrices:
+            matriz.flags.writeable = False
+        resultado = reconstruir_resultado(estructura, matrices)
+
+        ruta_tmp = os.path.join(self.directorio, 'tmp-' + clave + '-' + str(os.getpid()) + '-' + str(threading.get_ident()))
+        os.makedirs(ruta_tmp, exist_ok=True)
+        for k, matriz in enumerate(matrices):
+            np.save(os.path.join(ruta_tmp, str(k) + '.npy'), matriz)
+        with open(os.path.join(ruta_tmp, 'info.json'), 'w') as archivo:
+            json.dump(dict(estructura=estructura, matrices=len(matrices)), archivo)
+        tamano = tamano_entrada(ruta_tmp)
+
+        with self._cerrojo:
+            ruta = os.path.join(self.directorio, clave)
+            try:
+                os.rename(ruta_tmp, ruta) #Se escribe completa o no se escribe.
+            except OSError: #Otro proceso la guardó antes.
+                shutil.rmtree(ruta_tmp, ignore_errors=True)
+                if clave not in self._disco and os.path.isdir(ruta):
+                    self._disco[clave] = tamano_entrada(ruta)
+                    self._bytes_disco += self._disco[clave]
+            else:
+                self._disco[clave] = tamano
+                self._bytes_disco += tamano
+                self._estadisticas['guardados'] += 1
+                self._liberar_disco(clave)
+
+            self._guardar_memoria(clave, resultado, matrices)
+
+        return resultado
+
+    def _guardar_memoria(self, clave, resultado, matrices):
+        tamano = sum(matriz.nbytes for matriz in matrices)
+        if tamano > self.limite_memoria:
+            return
+
+        self._memoria[clave] = (resultado, tamano)
+        self._bytes_memoria += tamano
+        while self._bytes_memoria > self.limite_memoria: #Se quitan los menos usados.
+            _, (_, tamano_viejo) = self._memoria.popitem(last=False)
+            self._bytes_memoria -= tamano_viejo
+
+    def _escanear_disco(self):
+        entradas = [] #También las que han guardado otros procesos.
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            if nombre.startswith('tmp') or not os.path.isdir(ruta):
+                continue
+            try:
+                tamano = self._disco[nombre] if nombre in self._disco else tamano_entrada(ruta)
+                entradas.append((os.path.getmtime(ruta), nombre, tamano))
+            except OSError: #Otro proceso la acaba de borrar.
+                continue
+        self._disco = OrderedDict((nombre, tamano) for _, nombre, tamano in sorted(entradas))
+        self._bytes_disco = sum(self._disco.values())
+
+    def _liberar_disco(self, clave_nueva):
+        self._escanear_disco() #El límite es para toda la carpeta, no para cada proceso.
+        while self._bytes_disco > self.limite_disco and len(self._disco) > 1:
+            clave, tamano = next(iter(self._disco.items())) #La usada hace más tiempo.
+            if clave == clave_nueva:
+                break
+            del self._disco[clave]
+            self._bytes_disco -= tamano
+            shutil.rmtree(os.path.join(self.directorio, clave), ignore_errors=True)
+            self._estadisticas['borrados'] += 1
+
+    def estadisticas(self):
+        '''
+        Aciertos (en memoria y en disco), fallos, resultados guardados y borrados, y bytes ocupados.
+        '''
+
+        with self._cerrojo:
+            estadisticas = dict(self._estadisticas)
+            estadisticas['bytes_memoria'] = self._bytes_memoria
+            estadisticas['bytes_disco'] = self._bytes_disco
+            estadisticas['entradas_disco'] = len(self._disco)
+        return estadisticas
+
+    def vaciar(self):
+        '''
+        Borra todos los resultados guardados (en memoria y en disco).
+        '''
+
+        with self._cerrojo:
+            self._escanear_disco()
+            for clave in list(self._disco):
+                shutil.rmtree(os.path.join(self.directorio, clave), ignore_errors=True)
+            self._disco.clear()
+            self._memoria.clear()
+            self._bytes_disco = 0
+            self._bytes_memoria = 0
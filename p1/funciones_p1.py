@@ -2,15 +2,14 @@ from matplotlib import pylab
 from matplotlib import pyplot as plt
 import pydicom
 import numpy as np
-import random
-import skimage
 from skimage.transform import resize
 from sklearn.feature_extraction import image
-from skimage.util import pad
+from sklearn.decomposition import PCA
+from sklearn.neighbors import KDTree, BallTree
 from skimage.restoration import denoise_nl_means
 from skimage import data
-from skimage import filters
-from numba import prange, njit #Se runea en multiples CPUs
+from numba import prange, njit, get_num_threads #Se runea en multiples CPUs
+from filtro_anisotropico import filtro_anisotropico
 
 
 #NORMALIZACIÓN.
@@ -25,96 +24,181 @@ def normalizar(imagen):
         matriz_norm : matriz de píxeles de la imagen normalizada (valores entre 0 y 1).
     
     Notas:
-        Se lee el archivo y se extrae la matriz de píxeles. Si hay algún píxel con valor negativo, 
-        se le suma el mínimo valor de la imagen, haciendo así que toda la matriz tenga valores positivos.
-        Por último, para que dichas intensidades de píxel estén comprendidas entre 0 y 1, se divide 
-        cada píxel entre el máximo valor de la matriz.
+        Se lee el archivo, se extrae la matriz de píxeles y se normaliza con normalizar_matriz.
     '''
     
     dataset = pydicom.dcmread(imagen)
     matriz_pixel = dataset.pixel_array #Matriz de píxeles.
-    valor_min = np.amin(matriz_pixel) #Valor mínimo de píxel en esta matriz.
+    matriz_norm = normalizar_matriz(matriz_pixel, dtype=np.float64)
 
-    #Normalización en 2 pasos.
-    if valor_min < 0: #Si la matriz tiene algún valor negativo. 
+    return matriz_norm
+
+
+#MÍNIMO Y MÁXIMO EN UNA PASADA.
+@njit(cache=True)
+def min_max(matriz):
+    '''
+    Valor mínimo y máximo de la matriz, recorriéndola una sola vez.
+    '''
+
+    valor_min = np.inf
+    valor_max = -np.inf
+    for valor in matriz.flat:
+        if valor < valor_min:
+            valor_min = valor
+        if valor > valor_max:
+            valor_max = valor
+
+    return valor_min, valor_max
+
+
+#NORMALIZACIÓN DE UNA MATRIZ DE PÍXELES.
+def normalizar_matriz(matriz_pixel, dtype=np.float32, modo='corte', out=None, ventana=None, pendiente=1, intercepto=0):
+    '''
+    Normalización de una matriz de píxeles o de una pila de cortes.
+    
+    Parámetros:
+        matriz_pixel : matriz de píxeles de la imagen (filas x columnas) o pila (cortes x filas x columnas).
+        dtype : tipo de la matriz normalizada si no se da out.
+        modo : 'corte' (cada corte de la pila con su mínimo y máximo) o 'global' (toda la pila a la vez).
+        out : matriz donde se escribe el resultado. Puede ser la propia matriz_pixel si es de tipo float.
+        ventana : tupla (centro, anchura) de la ventana DICOM. Si se da, se usa en lugar del mínimo y máximo.
+        pendiente, intercepto : RescaleSlope y RescaleIntercept del DICOM (para pasar a unidades Hounsfield).
         
-        #PAS0 1: Sumamos el valor mínimo a cada elemento de la matriz.
-        matriz_valormin = -(valor_min)*np.ones((512, 512))
-        matriz_suma = matriz_pixel + matriz_valormin #Pixels de la matriz positivos.
+    Devuelve:
+        matriz_norm : matriz de píxeles de la imagen normalizada (valores entre 0 y 1).
+    
+    Notas:
+        Todo se calcula sobre la matriz de salida, sin matrices intermedias del tamaño de la imagen. 
+        Primero se copia la matriz en el tipo pedido y se aplican pendiente e intercepto. Con ventana, los
+        valores de [centro - anchura/2, centro + anchura/2] se llevan a [0, 1] y el resto se recorta.
+        Sin ventana, el mínimo y el máximo se buscan en una sola pasada. Si hay algún píxel con valor 
+        negativo, se le suma el mínimo valor de la imagen, haciendo así que toda la matriz tenga valores 
+        positivos. Por último, para que dichas intensidades de píxel estén comprendidas entre 0 y 1, se 
+        divide cada píxel entre el máximo valor de la matriz. Una imagen con máximo 0 se deja a 0.
+    '''
+
+    if modo not in ('corte', 'global'):
+        raise ValueError("'modo' debe ser 'corte' o 'global'.")
 
-        #PASO 2: Dividimos cada píxel de la matriz entre su máximo valor.
-        valor_max = np.amax(matriz_suma) 
-        matriz_norm = (1/valor_max)*matriz_suma #Valores de píxel entre 0 y 1.
+    matriz_norm = np.empty(matriz_pixel.shape, dtype=dtype) if out is None else out
+    np.copyto(matriz_norm, matriz_pixel, casting='unsafe')
+    tipo = matriz_norm.dtype.type
 
-    else: 
-        #Dividimos cada píxel de la matriz entre su máximo valor.
-        valor_max = np.amax(matriz_pixel)
-        matriz_norm = (1/valor_max)*matriz_pixel #Valores de píxel entre 0 y 1.
+    if pendiente != 1 or intercepto != 0: #Valores en unidades del DICOM.
+        matriz_norm *= pendiente
+        matriz_norm += intercepto
+
+    if ventana is not None:
+        centro, anchura = ventana
+        matriz_norm -= centro - anchura/2 #Inicio de la ventana en 0.
+        matriz_norm *= 1/anchura #Final de la ventana en 1.
+        np.clip(matriz_norm, 0, 1, out=matriz_norm)
+        return matriz_norm
+
+    if modo == 'corte' and matriz_norm.ndim == 3:
+        partes = list(matriz_norm) #Cada corte por separado (vistas, sin copias).
+    else:
+        partes = [matriz_norm]
+
+    for parte in partes:
+        valor_min, valor_max = min_max(parte) #Valores mínimo y máximo de píxel en esta matriz.
+
+        #Normalización en 2 pasos.
+        if valor_min < 0: #Si la matriz tiene algún valor negativo.
+            parte += -(valor_min) #PASO 1: Pixels de la matriz positivos.
+            valor_max = tipo(valor_max) + tipo(-(valor_min)) #Máximo después de sumar.
+
+        if valor_max != 0: #PASO 2: Dividimos cada píxel de la matriz entre su máximo valor.
+            parte *= 1/valor_max #Valores de píxel entre 0 y 1.
 
     return matriz_norm
 
 
 #ADICIÓN DE RUIDO IMPULSIVO (SAL PIMIENTA).
-def ruido_SP(imagen, porcentaje_ruido): #El valor de porcentaje_ruido añade más o menos ruido a la imagen
+def ruido_SP(imagen, porcentaje_ruido, semilla=None, dtype=np.float32, out=None, mascara_limpia=None): #El valor de porcentaje_ruido añade más o menos ruido a la imagen
     '''
     Adición de ruido impulsivo (sal pimienta).
     
     Parámetros:
-        imagen : matriz de píxeles normalizada.
+        imagen : matriz de píxeles normalizada (o pila de imágenes N x filas x columnas).
         porcentaje_ruido : valor que determina la cantidad de ruido que tendrá la imagen.
+        semilla : semilla (o numpy.random.Generator) para que el ruido sea reproducible.
+        dtype : tipo de la matriz de salida si no se da out.
+        out : matriz donde se escribe el resultado. Puede ser la propia imagen (ruido en el sitio).
+        mascara_limpia : matriz booleana con los píxeles que se dejan sin ruido. Puede tener el tamaño 
+            de una sola imagen y se aplica a toda la pila.
         
     Devuelve:
         img_SP : matriz de píxeles de la imagen con ruido impulsivo
     
     Notas:
-        Se crea una matriz vacía con la misma dimensión que la imagen normalizada (es importante que la 
-        matriz esté normalizada para que los niveles de grises vayan de 0, negro absoluto, a 1, blanco
-        absoluto). Se recorre dicha imagen y en función de un valor aleatorio se reemplazará el valor del 
-        píxel por 0, 1 o se mantendrá intensidad original. 
+        Es importante que la imagen esté normalizada para que los niveles de grises vayan de 0, negro 
+        absoluto, a 1, blanco absoluto. Se genera de una vez un valor aleatorio por píxel y, en función de
+        él, se reemplaza el valor del píxel por 0, 1 o se mantiene la intensidad original. 
     '''
 
-    img_SP = np.ones(imagen.shape) #Creamos matriz de 1. 
-    umbral = 1-porcentaje_ruido #Umbral relacionado con porcentaje de ruido. 
-
-    #Se recorre la imagen. 
-    for i in range(imagen.shape[0]):
-        for j in range(imagen.shape[1]):
-            rdn = random.random() #Valores aleatorios entre 0, 1.
-            
-            if rdn < porcentaje_ruido:
-                img_SP[i][j] = 0 #Se cambia por negro absoluto.
+    rng = np.random.default_rng(semilla) #Generador de números aleatorios.
+    img_SP = np.empty(imagen.shape, dtype=dtype) if out is None else out
+    if img_SP is not imagen:
+        np.copyto(img_SP, imagen, casting='unsafe') #Se mantiene la intensidad de píxel.
 
-            elif rdn > umbral:
-                img_SP[i][j] = 1 #Se cambia por blanco absoluto. 
+    rdn = rng.random(imagen.shape, dtype=np.float32) #Valores aleatorios entre 0, 1.
+    umbral = 1-porcentaje_ruido #Umbral relacionado con porcentaje de ruido. 
+    blanco = rdn > umbral
+    negro = rdn < porcentaje_ruido
+    if mascara_limpia is not None: #Los píxeles de la máscara no se tocan.
+        limpios = np.asarray(mascara_limpia, dtype=bool)
+        blanco &= ~limpios
+        negro &= ~limpios
 
-            else:
-                img_SP[i][j] = imagen[i][j] #Se mantiene la intensidad de píxel. 
+    img_SP[blanco] = 1 #Se cambia por blanco absoluto. 
+    img_SP[negro] = 0 #Se cambia por negro absoluto (tiene prioridad, como en la versión con bucles).
 
     return img_SP
 
 
 #ADICIÓN DE RUIDO GAUSSIANO.
-def ruido_gaussiano(imagen, media, sigma): #Cuanto menor sea el parámetro sigma, menos ruido se añade a la imagen
+def ruido_gaussiano(imagen, media, sigma, semilla=None, dtype=np.float32, out=None): #Cuanto menor sea el parámetro sigma, menos ruido se añade a la imagen
     '''
     Adición de ruido gaussiano.
     
     Parámetros:
-        imagen : matriz de píxeles normalizada.
+        imagen : matriz de píxeles normalizada (o pila de imágenes N x filas x columnas).
         media : media de la gaussiana.
         sigma : desviación típica de la gaussiana. 
+        semilla : semilla (o numpy.random.Generator) para que el ruido sea reproducible.
+        dtype : tipo de la matriz de salida si no se da out.
+        out : matriz donde se escribe el resultado. Puede ser la propia imagen (ruido en el sitio).
         
     Devuelve:
         img_gauss : matriz de píxeles de la imagen con ruido gaussiano. 
     
     Notas:
-        Se crea la matriz de gauss que muestra la densidad de probabilidad que responde a una 
-        distribución normal (gaussiana) cuyos parámetros son los argumentos de la función (media,
-        sigma). Por último, se le suma a la matriz normalizada.  
+        Se genera ruido que sigue una distribución normal (gaussiana) cuyos parámetros son los 
+        argumentos de la función (media, sigma) y se le suma a la matriz normalizada. El ruido se 
+        genera directamente en la matriz de salida, en su tipo (float32 por defecto). Si la salida es la
+        propia imagen, se genera imagen a imagen (o fila a fila) para no crear otra matriz completa.
     '''
 
-    dimension = imagen.shape #Dimensión de la matriz.
-    gauss = np.random.normal(media,sigma,dimension) #Distribución normal.
-    img_gauss = imagen + gauss #Imagen con ruido. 
+    rng = np.random.default_rng(semilla) #Generador de números aleatorios.
+    img_gauss = np.empty(imagen.shape, dtype=dtype) if out is None else out
+
+    directo = (img_gauss.dtype in (np.float32, np.float64) and img_gauss.flags.c_contiguous
+               and not np.shares_memory(img_gauss, imagen))
+
+    if directo: #Ruido generado en la propia salida.
+        rng.standard_normal(out=img_gauss, dtype=img_gauss.dtype)
+        img_gauss *= sigma
+        img_gauss += media
+        img_gauss += imagen #Imagen con ruido. 
+    else: #Ruido generado por partes.
+        gauss = np.empty(imagen.shape[1:], dtype=img_gauss.dtype)
+        for k in range(imagen.shape[0]):
+            rng.standard_normal(out=gauss, dtype=gauss.dtype) #Distribución normal.
+            gauss *= sigma
+            gauss += media
+            np.add(imagen[k], gauss, out=img_gauss[k], casting='unsafe')
 
     return img_gauss
 
@@ -140,8 +224,70 @@ def redimensionar(imagen, dimension):
     return img_redim
 
 
+#DISTANCIAS DE UN PARCHE FIJO A TODOS LOS PARCHES.
+@njit(cache=True)
+def distancias_parche(img_padding, dim_parche, p, q, dist_array):
+    '''
+    Distancias euclídeas del parche del píxel (p, q) a los parches de todos los píxeles.
+    
+    Parámetros:
+        img_padding : matriz de píxeles con padding.
+        dim_parche : dimensión del parche.
+        p, q : fila y columna (sin padding) del píxel del parche fijo.
+        dist_array : matriz del tamaño de la imagen donde se guardan las distancias. 
+    
+    Notas:
+        Las restas se hacen directamente sobre img_padding, sin copiar los parches, y en el mismo
+        orden que np.sum, para que las distancias sean idénticas a las de la versión con parches.
+        Igual que en NLM, la distancia del parche fijo a sí mismo vale 1.
+    '''
+
+    for a in range(dist_array.shape[0]): #Filas.
+        for b in range(dist_array.shape[1]): #Columnas.
+            suma = 0.0
+            for k in range(dim_parche):
+                for l in range(dim_parche):
+                    resta = img_padding[p+k, q+l] - img_padding[a+k, b+l]
+                    suma += resta**2
+            dist_array[a, b] = np.sqrt(suma)
+
+    dist_array[p, q] = 1 #Distancia alta para que salga un peso bajo en la posición del parche fijo.
+
+
 #NON LOCAL MEANS.
-@njit(parallel=True)
+@njit(parallel=True, cache=True)
+def nucleo_NLM(imagen, img_padding, dim_parche, h_cuadrado, n_bloques):
+    '''
+    Núcleo compilado de NLM. Las filas se reparten en n_bloques bloques, uno por hilo.
+    '''
+
+    filas, columnas = imagen.shape
+    img_nlm = np.ones(imagen.shape) #Matriz de 1. 
+
+    for bloque in prange(n_bloques):
+        dist_array = np.empty(imagen.shape) #Matriz de distancias del hilo (se reutiliza).
+
+        for i in range(bloque*filas//n_bloques, (bloque+1)*filas//n_bloques): #Filas del bloque.
+            for j in range(columnas): #Columnas.
+                distancias_parche(img_padding, dim_parche, i, j, dist_array)
+
+                z_coef = 0.0 #Valor para cada parche fijo.
+                for a in range(filas):
+                    for b in range(columnas):
+                        w = np.exp(-(dist_array[a, b])/(h_cuadrado))
+                        dist_array[a, b] = w #Se guarda el peso en lugar de la distancia.
+                        z_coef += w
+
+                factor = 1/z_coef
+                pixel_filtrado = 0.0
+                for a in range(filas):
+                    for b in range(columnas):
+                        pixel_filtrado += (factor*dist_array[a, b])*imagen[a, b] #Pixel por su ponderación.
+                img_nlm[i, j] = pixel_filtrado
+    
+    return img_nlm
+
+
 def NLM (imagen, img_padding, dim_parche, h_cuadrado):
     '''
     Filtro Non-Local Means.
@@ -157,39 +303,59 @@ def NLM (imagen, img_padding, dim_parche, h_cuadrado):
     
     Notas:
         Se filtra la imagen mediante un promedio ponderado de los píxeles de la imagen con ruido en
-        función de la similitud de cada uno de los píxeles con lo demás.
+        función de la similitud de cada uno de los píxeles con lo demás. Las filas se reparten en bloques
+        entre los hilos (prange) y cada hilo reutiliza su propia matriz de distancias para todos sus píxeles.
     '''
     
-    img_nlm = np.ones(imagen.shape) #Matriz de 1. 
+    n_bloques = min(get_num_threads(), imagen.shape[0]) #Un bloque de filas por hilo.
 
-    for i in range(1,img_padding.shape[0]-1): #Itera la matriz de la imagen con padding - Filas.
-        for j in range(1,img_padding.shape[1]-1): #Itera la matriz de la imagen con padding - Columnas.
-            parche_fijo = img_padding[i-1:i+dim_parche-1, j-1:j+dim_parche-1] #Parche de 3x3 (en nuestro caso).
-            
-            dist_array = np.ones(imagen.shape) #Matriz de distancias.
-        
-            for a in range(1,img_padding.shape[0]-1): #Itera la matriz de la imagen - Filas
-                for b in range(1,img_padding.shape[1]-1): #Itera la matriz de la imagen - Columnas
-                
-                    parche_movil = img_padding[a-1:a+dim_parche-1, b-1:b+dim_parche-1] #Parche de 3x3 (en nuestro caso) 
-                    resta_parches = (parche_fijo - parche_movil)**2 #Matriz 3x3 (en nuestro caso) 
-                    dist_euclidea = np.sqrt(np.sum(resta_parches)) #Valor de la distancia de cada parche fijo al móvil. 
-                    dist_array[a-1][b-1] = dist_euclidea #Por el padding. 
-            
-            dist_array[i-1][j-1] = 1 #Distancia alta para que salga un peso bajo cuando estamos en la posición del parche fijo.
-            w = np.exp(-(dist_array)/(h_cuadrado)) 
-            z_coef = np.sum(w) #Valor para cada parche fijo. 
-        
-            peso = (1/z_coef)*w #Matriz de pesos. 
-        
-            pixel_filtrado = np.sum(peso * imagen) #Se multiplica el pixel por cada ponderación y se suma.
-            img_nlm[i-1][j-1] = pixel_filtrado #Por el padding. 
-    
-    return img_nlm
+    return nucleo_NLM(imagen, img_padding, dim_parche, h_cuadrado, n_bloques)
 
 
 #NON LOCAL MEANS - CPP
-@njit(parallel=True)
+@njit(parallel=True, cache=True)
+def nucleo_NLM_CPP(imagen, img_padding, dim_parche, h_cuadrado, D0, alpha, n_bloques):
+    '''
+    Núcleo compilado de NLM_CPP. Las filas se reparten en n_bloques bloques, uno por hilo.
+    '''
+
+    filas, columnas = imagen.shape
+    img_nlm_cpp = np.zeros(imagen.shape) #Matriz de 0. 
+
+    for bloque in prange(n_bloques):
+        dist_array = np.empty(imagen.shape) #Matriz de distancias del hilo (se reutiliza).
+
+        for i in range(bloque*filas//n_bloques, (bloque+1)*filas//n_bloques): #Filas del bloque.
+            for j in range(columnas): #Columnas.
+                distancias_parche(img_padding, dim_parche, i, j, dist_array)
+                pixel_fijo = img_padding[i, j] #Píxel central fijo (mismo criterio que la versión original).
+
+                z_coef = 0.0 #Valor para cada parche fijo.
+                for a in range(filas):
+                    for b in range(columnas):
+                        w = np.exp(-(dist_array[a, b])/(h_cuadrado))
+                        dist_array[a, b] = w
+                        z_coef += w
+
+                factor = 1/z_coef
+                suma_cpp = 0.0
+                for a in range(filas):
+                    for b in range(columnas):
+                        resta_pixeles_centrados = np.abs(pixel_fijo - img_padding[a, b])
+                        n = 1/(1+(resta_pixeles_centrados/D0)**(2*alpha))
+                        peso_cpp = (factor*dist_array[a, b])*n #Nuevo peso para cada píxel.
+                        dist_array[a, b] = peso_cpp
+                        suma_cpp += peso_cpp
+
+                pixel_filtrado = 0.0
+                for a in range(filas):
+                    for b in range(columnas):
+                        pixel_filtrado += (dist_array[a, b]/suma_cpp)*imagen[a, b] #Pesos normalizados.
+                img_nlm_cpp[i, j] = pixel_filtrado
+    
+    return img_nlm_cpp
+
+
 def NLM_CPP (imagen, img_padding, dim_parche, h_cuadrado, D0, alpha):
     '''
     Filtro Non-Local Means con modificación CPP.
@@ -209,47 +375,345 @@ def NLM_CPP (imagen, img_padding, dim_parche, h_cuadrado, D0, alpha):
         Se filtra la imagen mediante un promedio ponderado de los píxeles de la imagen con ruido en
         función de la similitud de cada uno de los píxeles con lo demás. Como se devuelve una imagen muy
         suavizada, con la modificación CPP se ponderarán los pesos originales del NLM para que dependan 
-        también de la similitud entre píxeles centrales. 
+        también de la similitud entre píxeles centrales. Se paraleliza igual que NLM y la diferencia entre
+        píxeles centrales se calcula al vuelo, sin guardarla en una matriz.
     '''
 
-    img_nlm_cpp = np.zeros(imagen.shape) #Matriz de 1. 
+    n_bloques = min(get_num_threads(), imagen.shape[0]) #Un bloque de filas por hilo.
 
-    for i in range(1,img_padding.shape[0]-1): #Itera la matriz de la imagen con padding - Filas.
-        for j in range(1,img_padding.shape[1]-1): #Itera la matriz de la imagen con padding - Columnas.
-            parche_fijo = img_padding[i-1:i+dim_parche-1, j-1:j+dim_parche-1] #Parche de 3x3 fijo.
-            pixel_fijo = img_padding[i-1][j-1] #Píxel central fijo. 
-            
-            dist_array = np.zeros(imagen.shape) #Matriz de distancias para cada fijo. 
-            resta_pixeles_centrados = np.zeros(imagen.shape)#Matriz de 0. 
-            
-            for a in range(1,img_padding.shape[0]-1): #Itera la matriz de la imagen con padding - Filas.
-                for b in range(1,img_padding.shape[1]-1): #Itera la matriz de la imagen con padding  - Columnas.
-                    parche_movil = img_padding[a-1:a+dim_parche-1, b-1:b+dim_parche-1] #Parche de 3x3 móvil. 
-                    pixel_movil = img_padding[a-1][b-1] #Píxel central móvil.
-                    
-                    resta_pixeles_centrados [a-1][b-1] = np.abs(pixel_fijo - pixel_movil)
-                    resta_parches = (parche_fijo - parche_movil)**2 #Matriz 3x3.
-                    
-                    dist_euclidea = np.sqrt(np.sum(resta_parches)) #Valor para cada parche móvil. 
-                    dist_array[a-1][b-1] = dist_euclidea #Matriz de 64 valores para cada parche moóvil. 
-            
-            dist_array[i-1][j-1] = 1 #Distancia alta para que salga un peso bajo cuando estamos en la posición del parche fijo.
-           
-            n = 1/(1+(resta_pixeles_centrados/D0)**(2*alpha)) 
-            w = np.exp(-(dist_array)/(h_cuadrado))
-            z_coef = np.sum(w) #Valor para cada parche fijo.   
+    return nucleo_NLM_CPP(imagen, img_padding, dim_parche, h_cuadrado, D0, alpha, n_bloques)
+
+
+#NON LOCAL MEANS Y NON LOCAL MEANS - CPP EN UNA PASADA.
+@njit(parallel=True, cache=True)
+def nucleo_NLM_y_CPP(imagen, img_padding, dim_parche, h_cuadrado, parametros_cpp, n_bloques):
+    '''
+    Núcleo compilado de NLM_y_CPP. Cada fila de parametros_cpp es una pareja (D0, alpha) seguida de
+    un 1 si alpha es un exponente entero (como en NLM_CPP con alpha int) o un 0 si no. Las filas de
+    la imagen se reparten en n_bloques bloques, uno por hilo.
+    '''
+
+    filas, columnas = imagen.shape
+    n_cpp = parametros_cpp.shape[0]
+    img_nlm = np.ones(imagen.shape) #Matriz de 1.
+    pila_cpp = np.zeros((n_cpp, filas, columnas)) #Una imagen CPP por pareja (D0, alpha).
+
+    for bloque in prange(n_bloques):
+        dist_array = np.empty(imagen.shape) #Distancias y después pesos del NLM.
+        resta_pixeles_centrados = np.empty(imagen.shape) #Diferencias entre píxeles centrales.
+        peso_cpp = np.empty(imagen.shape) #Pesos CPP de la pareja actual.
+
+        for i in range(bloque*filas//n_bloques, (bloque+1)*filas//n_bloques): #Filas del bloque.
+            for j in range(columnas): #Columnas.
+                distancias_parche(img_padding, dim_parche, i, j, dist_array)
+                pixel_fijo = img_padding[i, j] #Píxel central fijo (mismo criterio que NLM_CPP).
+
+                z_coef = 0.0
+                for a in range(filas):
+                    for b in range(columnas):
+                        w = np.exp(-(dist_array[a, b])/(h_cuadrado))
+                        dist_array[a, b] = w
+                        z_coef += w
+                        resta_pixeles_centrados[a, b] = np.abs(pixel_fijo - img_padding[a, b])
+
+                factor = 1/z_coef
+                pixel_filtrado = 0.0
+                for a in range(filas):
+                    for b in range(columnas):
+                        pixel_filtrado += (factor*dist_array[a, b])*imagen[a, b]
+                img_nlm[i, j] = pixel_filtrado
+
+                for c in range(n_cpp): #Se reutilizan pesos y diferencias para cada pareja.
+                    D0 = parametros_cpp[c, 0]
+                    alpha = parametros_cpp[c, 1]
+                    alpha_entero = parametros_cpp[c, 2] != 0 #Potencia entera, como en NLM_CPP con alpha int.
+
+                    suma_cpp = 0.0
+                    for a in range(filas):
+                        for b in range(columnas):
+                            if alpha_entero:
+                                n = 1/(1+(resta_pixeles_centrados[a, b]/D0)**(2*np.int64(alpha)))
+                            else:
+                                n = 1/(1+(resta_pixeles_centrados[a, b]/D0)**(2*alpha))
+                            peso = (factor*dist_array[a, b])*n
+                            peso_cpp[a, b] = peso
+                            suma_cpp += peso
+
+                    pixel_filtrado = 0.0
+                    for a in range(filas):
+                        for b in range(columnas):
+                            pixel_filtrado += (peso_cpp[a, b]/suma_cpp)*imagen[a, b]
+                    pila_cpp[c, i, j] = pixel_filtrado
+
+    return img_nlm, pila_cpp
+
+
+def NLM_y_CPP(imagen, img_padding, dim_parche, h_cuadrado, parametros_cpp):
+    '''
+    Filtros Non-Local Means y Non-Local Means - CPP calculados a la vez.
+    
+    Parámetros:
+        imagen : matriz de píxeles normalizada con ruido.
+        img_padding : matriz de píxeles con padding.
+        dim_parche : dimensión del parche que se necesita a la hora de filtrar. Para esta práctica 3.
+        h_cuadrado : parámetro de similitud asociado al grado de filtrado que se desea aplicar.
+        parametros_cpp : lista de parejas (D0, alpha) para las que se quiere la imagen CPP.
         
-            peso = (1/z_coef)*w
-            peso_cpp = peso*n #Nuevo peso para cada píxel.
-            peso_cpp_norm = peso_cpp/np.sum(peso_cpp)#Normalización de los pesos. 
-            
-            img_nlm_cpp[i-1][j-1] = np.sum(peso_cpp_norm*imagen)#Se multiplica el pixel por cada ponderación y se suma.
+    Devuelve:
+        img_nlm : matriz de píxeles de la imagen filtrada con NLM.
+        imgs_nlm_cpp : lista con una imagen filtrada con NLM_CPP por cada pareja (D0, alpha).
     
-    return img_nlm_cpp
+    Notas:
+        Las distancias entre parches, los pesos del NLM y las diferencias entre píxeles centrales solo
+        dependen de la imagen, así que se calculan una vez por píxel y se reutilizan para el NLM y para
+        todas las parejas (D0, alpha). El resultado es el mismo que llamar a NLM y a NLM_CPP por separado.
+    '''
+
+    parametros = np.zeros((len(parametros_cpp), 3)) #Matriz (k, 3).
+    for c, (D0, alpha) in enumerate(parametros_cpp):
+        parametros[c] = D0, alpha, isinstance(alpha, (int, np.integer))
+    n_bloques = min(get_num_threads(), imagen.shape[0]) #Un bloque de filas por hilo.
+    img_nlm, pila_cpp = nucleo_NLM_y_CPP(imagen, img_padding, dim_parche, h_cuadrado, parametros, n_bloques)
+    imgs_nlm_cpp = list(pila_cpp) #Una imagen por pareja.
+
+    return img_nlm, imgs_nlm_cpp
+
+
+#NON LOCAL MEANS - BARRIDO DE h.
+@njit(parallel=True, cache=True)
+def nucleo_NLM_barrido_h(imagen, img_padding, dim_parche, valores_h, referencia, con_referencia, n_bloques):
+    '''
+    Núcleo compilado de NLM_barrido_h. Devuelve la pila de imágenes y la suma de errores al cuadrado
+    de cada h (ceros si no hay referencia).
+    '''
+
+    filas, columnas = imagen.shape
+    n_h = valores_h.shape[0]
+    pila_nlm = np.ones((n_h, filas, columnas)) #Una imagen por valor de h.
+    error_bloques = np.zeros((n_bloques, n_h)) #Error acumulado por cada hilo.
+
+    for bloque in prange(n_bloques):
+        dist_array = np.empty(imagen.shape) #Distancias del píxel actual (se reutilizan para cada h).
+        pesos = np.empty(imagen.shape) #Pesos para el h actual.
+
+        for i in range(bloque*filas//n_bloques, (bloque+1)*filas//n_bloques): #Filas del bloque.
+            for j in range(columnas): #Columnas.
+                distancias_parche(img_padding, dim_parche, i, j, dist_array)
+
+                for k in range(n_h):
+                    h_cuadrado = valores_h[k]
+
+                    z_coef = 0.0
+                    for a in range(filas):
+                        for b in range(columnas):
+                            w = np.exp(-(dist_array[a, b])/(h_cuadrado))
+                            pesos[a, b] = w
+                            z_coef += w
+
+                    factor = 1/z_coef
+                    pixel_filtrado = 0.0
+                    for a in range(filas):
+                        for b in range(columnas):
+                            pixel_filtrado += (factor*pesos[a, b])*imagen[a, b]
+                    pila_nlm[k, i, j] = pixel_filtrado
+
+                    if con_referencia: #Puntuación al vuelo.
+                        error_bloques[bloque, k] += (pixel_filtrado - referencia[i, j])**2
+
+    return pila_nlm, error_bloques.sum(axis=0)
+
+
+def NLM_barrido_h(imagen, img_padding, dim_parche, valores_h, referencia=None):
+    '''
+    Filtro Non-Local Means para varios valores de h_cuadrado.
+    
+    Parámetros:
+        imagen : matriz de píxeles normalizada con ruido.
+        img_padding : matriz de píxeles con padding.
+        dim_parche : dimensión del parche que se necesita a la hora de filtrar. Para esta práctica 3.
+        valores_h : lista de valores de h_cuadrado que se quieren probar.
+        referencia : matriz de píxeles de la imagen sin ruido (opcional). 
+        
+    Devuelve:
+        pila_nlm : matriz (número de h, filas, columnas) con la imagen filtrada para cada h.
+        ecm : error cuadrático medio de cada imagen respecto a la referencia (None si no hay referencia).
+    
+    Notas:
+        Las distancias entre parches no dependen de h. Se calculan una sola vez por píxel y se reutilizan
+        para todos los valores de h, así que cuesta casi lo mismo que un único NLM. Cada hilo trabaja con
+        un bloque de filas y solo guarda las distancias del píxel que está filtrando, por lo que la memoria
+        no crece con el número de h más allá de la propia pila de resultados. Si se da una referencia, el
+        error de cada h se va acumulando mientras se filtra. Cada imagen es la misma que la de NLM con ese h.
+    '''
+
+    valores = np.array(valores_h, dtype=np.float64).ravel()
+    con_referencia = referencia is not None
+    if con_referencia:
+        referencia = np.asarray(referencia, dtype=np.float64)
+    else:
+        referencia = np.zeros((1, 1)) #No se usa.
+
+    n_bloques = min(get_num_threads(), imagen.shape[0]) #Un bloque de filas por hilo.
+    pila_nlm, error = nucleo_NLM_barrido_h(imagen, img_padding, dim_parche, valores, referencia, con_referencia, n_bloques)
+    ecm = error/imagen.size if con_referencia else None
+
+    return pila_nlm, ecm
+
+
+#NON LOCAL MEANS - VECINOS MÁS CERCANOS (PCA).
+def NLM_PCA(imagen, img_padding, dim_parche, h_cuadrado, n_componentes=3, k_vecinos=30, arbol='kd'):
+    '''
+    Filtro Non-Local Means aproximado con los k parches más parecidos.
+    
+    Parámetros:
+        imagen : matriz de píxeles normalizada con ruido.
+        img_padding : matriz de píxeles con padding.
+        dim_parche : dimensión del parche que se necesita a la hora de filtrar. Para esta práctica 3.
+        h_cuadrado : parámetro de similitud asociado al grado de filtrado que se desea aplicar.
+        n_componentes : número de componentes principales con las que se describe cada parche.
+        k_vecinos : número de parches más parecidos que se promedian para cada píxel.
+        arbol : 'kd' (KDTree) o 'ball' (BallTree), estructura con la que se buscan los vecinos.
+        
+    Devuelve:
+        img_nlm : matriz de píxeles de la imagen filtrada.
+    
+    Notas:
+        Se extraen todos los parches de la imagen con padding (el parche del píxel (p, q) empieza en
+        img_padding[p, q], como en NLM) y se proyectan sobre sus primeras componentes principales. Con
+        los parches proyectados se construye un árbol y, para cada píxel, se buscan sus k_vecinos parches
+        más cercanos. Solo esos píxeles entran en el promedio, con los mismos pesos que en NLM. El coste
+        es del orden de N·log(N). Con más componentes y más vecinos el resultado se acerca al de NLM,
+        a cambio de tardar más.
+    '''
+
+    filas, columnas = imagen.shape
+    n_pixeles = filas*columnas
+
+    parches = image.extract_patches_2d(img_padding, (dim_parche, dim_parche)) #Un parche por píxel.
+    parches = parches.reshape(n_pixeles, dim_parche*dim_parche)
+
+    n_componentes = min(n_componentes, dim_parche*dim_parche)
+    parches_pca = PCA(n_components=n_componentes).fit_transform(parches) #Parches reducidos.
+
+    if arbol == 'kd':
+        indice = KDTree(parches_pca)
+    elif arbol == 'ball':
+        indice = BallTree(parches_pca)
+    else:
+        raise ValueError("'arbol' debe ser 'kd' o 'ball'.")
+
+    k_vecinos = min(k_vecinos, n_pixeles)
+    dist_array, vecinos = indice.query(parches_pca, k=k_vecinos) #Distancias y posiciones de los vecinos.
+    dist_array[vecinos == np.arange(n_pixeles)[:, None]] = 1 #Como en NLM, peso bajo para el propio parche.
+
+    w = np.exp(-(dist_array)/(h_cuadrado))
+    z_coef = np.sum(w, axis=1) #Valor para cada parche fijo.
+    pixeles_vecinos = imagen.ravel()[vecinos] #Intensidad de cada vecino.
+
+    img_nlm = (np.sum(w*pixeles_vecinos, axis=1)/z_coef).reshape(filas, columnas)
+
+    return img_nlm
+
+
+#DISTANCIAS ENTRE PARCHES PARA UN DESPLAZAMIENTO.
+def distancias_desplazamiento(img_padding, dim_parche, dy, dx, dimension):
+    '''
+    Distancias entre todos los parches de la imagen y los parches desplazados (dy, dx).
+
+    Parámetros:
+        img_padding : matriz de píxeles con padding.
+        dim_parche : dimensión del parche.
+        dy, dx : desplazamiento (filas, columnas) entre el parche fijo y el móvil.
+        dimension : dimensión de la imagen sin padding.
+
+    Devuelve:
+        zona : tupla (y0, y1, x0, x1) con los píxeles fijos cuyo píxel desplazado cae dentro de la imagen.
+        dist : matriz de distancias euclídeas de cada parche fijo de la zona a su parche desplazado.
+
+    Notas:
+        Se calcula la diferencia al cuadrado entre la imagen con padding y ella misma desplazada y se
+        acumula en una imagen integral (tabla de sumas acumuladas). La suma de cada parche sale de 4
+        accesos a la tabla, independientemente de su tamaño. Igual que en NLM, el parche del píxel (p, q)
+        es img_padding[p:p+dim_parche, q:q+dim_parche] y la distancia de un parche a sí mismo vale 1.
+        Si ningún píxel desplazado cae dentro de la imagen se devuelve None.
+    '''
+
+    filas, columnas = dimension
+    y0, y1 = max(0, -dy), min(filas, filas-dy) #Filas fijas válidas.
+    x0, x1 = max(0, -dx), min(columnas, columnas-dx) #Columnas fijas válidas.
+    if y0 >= y1 or x0 >= x1:
+        return None
+
+    if dy == 0 and dx == 0: #Parche fijo consigo mismo.
+        return (y0, y1, x0, x1), np.ones((y1-y0, x1-x0))
+
+    borde = dim_parche-1 #Píxeles extra que ocupan los parches.
+    zona_fija = img_padding[y0:y1+borde, x0:x1+borde]
+    zona_movil = img_padding[y0+dy:y1+dy+borde, x0+dx:x1+dx+borde]
+
+    #Imagen integral de las diferencias al cuadrado (con una fila y columna de ceros delante).
+    integral = np.zeros((zona_fija.shape[0]+1, zona_fija.shape[1]+1))
+    np.subtract(zona_fija, zona_movil, out=integral[1:, 1:])
+    np.square(integral[1:, 1:], out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=0, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+
+    d = dim_parche
+    dist = integral[d:, d:] - integral[:-d, d:] - integral[d:, :-d] + integral[:-d, :-d] #Suma de cada parche.
+    np.maximum(dist, 0, out=dist) #Se evitan negativos por redondeo.
+    np.sqrt(dist, out=dist)
+
+    return (y0, y1, x0, x1), dist
+
+
+#NON LOCAL MEANS - VENTANA DE BÚSQUEDA.
+def NLM_ventana(imagen, img_padding, dim_parche, h_cuadrado, radio_busqueda):
+    '''
+    Filtro Non-Local Means con ventana de búsqueda.
+
+    Parámetros:
+        imagen : matriz de píxeles normalizada con ruido.
+        img_padding : matriz de píxeles con padding.
+        dim_parche : dimensión del parche que se necesita a la hora de filtrar. Para esta práctica 3.
+        h_cuadrado : parámetro de similitud asociado al grado de filtrado que se desea aplicar.
+        radio_busqueda : radio (en píxeles) de la ventana de búsqueda alrededor de cada píxel.
+
+    Devuelve:
+        img_nlm : matriz de píxeles de la imagen filtrada.
+
+    Notas:
+        Cada parche solo se compara con los de una ventana de (2*radio_busqueda+1)x(2*radio_busqueda+1)
+        centrada en él. Se recorren los desplazamientos de la ventana y, para cada uno, se calculan a la
+        vez las distancias de todos los parches de la imagen con distancias_desplazamiento. El coste pasa
+        de O(N²·p²) a O(N·W²). Si la ventana cubre toda la imagen se obtiene el mismo resultado que con
+        NLM (salvo redondeo).
+    '''
+
+    dimension = imagen.shape
+    radio_y = min(radio_busqueda, dimension[0]-1) #No hace falta ir más allá de la imagen.
+    radio_x = min(radio_busqueda, dimension[1]-1)
+
+    suma_pesos = np.zeros(dimension) #Suma de los pesos de cada píxel (z_coef).
+    suma_ponderada = np.zeros(dimension) #Suma de los píxeles ponderados.
+
+    for dy in range(-radio_y, radio_y+1): #Desplazamientos de la ventana - Filas.
+        for dx in range(-radio_x, radio_x+1): #Desplazamientos de la ventana - Columnas.
+            resultado = distancias_desplazamiento(img_padding, dim_parche, dy, dx, dimension)
+            if resultado is None:
+                continue
+            (y0, y1, x0, x1), dist = resultado
+
+            w = np.exp(-(dist)/(h_cuadrado))
+            suma_pesos[y0:y1, x0:x1] += w
+            suma_ponderada[y0:y1, x0:x1] += w*imagen[y0+dy:y1+dy, x0+dx:x1+dx]
+
+    img_nlm = suma_ponderada/suma_pesos #Normalización de los pesos.
+
+    return img_nlm
 
 
 #FILTRO ANISOTRÓPICO
-def anisotropico(imagen, umbral, iteraciones):
+def anisotropico(imagen, umbral, iteraciones, modo='numba', tolerancia=0.0):
     '''
     Filtro anisotrópico.
     
@@ -257,6 +721,8 @@ def anisotropico(imagen, umbral, iteraciones):
         imagen : matriz de píxeles normalizada con ruido. 
         umbral : parámetro a comparar con el gradiente. 
         iteraciones : número de veces que pasa la imagen por el filtro. 
+        modo : 'numba' (mismo resultado que la versión con bucles), 'vectorizado' o 'activo'.
+        tolerancia : en modo 'activo', cambio mínimo para seguir iterando sobre un píxel.
         
     Devuelve:
         img_anisotropico : matriz de píxeles de la imagen filtrada con el filtro anisotrópico. 
@@ -265,43 +731,9 @@ def anisotropico(imagen, umbral, iteraciones):
         Se coge una imagen con ruido y se calcula el gradiente de cada píxel, con una máscara de Sobel. 
         A continuación, se compara cada gradiente con un umbral deseado y en función del valor, 
         se pasa el píxel a través de un filtro de media o se mantiene. El proceso se realiza varias veces. 
+        El cálculo se hace en filtro_anisotropico.
     '''
     
-    contador = 0 #Contador de iteraciones.
-    img_sobel = skimage.filters.sobel(imagen) #Filtro derivativo (Máscara Sobel).
-    img_padding = pad(imagen, (1,1), 'edge') #Imagen ruidosa con padding. 
-
-    while contador < iteraciones: 
-        if contador == 0: #Coge la imagen con ruido.
-            
-            img_anisotropico = np.ones(imagen.shape) #Matriz de 1. 
-        
-            for i in range(img_sobel.shape[0]): #Itera la matriz de la imagen de Sobel - Filas.
-                for j in range(img_sobel.shape[1]): #Itera la matriz de la imagen de Sobel - Columnas.
-        
-                    if img_sobel[i][j] > umbral: #Gradiente de cada pixel ruidoso (se encuentra en la img_sobel).
-                        img_anisotropico[i][j] = imagen[i][j]  #Pixel de la imagen con ruido con borde.
-            
-                    else: 
-                        parche = img_padding[i:i+3, j:j+3] #Parche 3x3.
-                        img_anisotropico[i][j] = np.mean(parche) #Media del parche.
-        
-            contador = contador + 1  
-        
-        else: #Coge la imagen filtrada y se repite el mismo proceso. 
-            img_sobel = skimage.filters.sobel(img_anisotropico)
-            img_padding = pad(img_anisotropico, (1,1), 'edge')
-       
-            for i in range(img_sobel.shape[0]): 
-                for j in range(img_sobel.shape[1]): 
-        
-                    if img_sobel[i][j] > umbral: 
-                        img_anisotropico[i][j] = img_anisotropico[i][j]
-            
-                    else:
-                        parche = img_padding[i:i+3, j:j+3] 
-                        img_anisotropico[i][j] = np.mean(parche) 
-    
-            contador = contador + 1 #Seguimos con la siguiente iteración. 
+    img_anisotropico = filtro_anisotropico(imagen, umbral, iteraciones, modo, tolerancia)
             
     return img_anisotropico
\ No newline at end of file
@@ -0,0 +1,150 @@
+'''
+Carga de series DICOM (un directorio con un archivo .dcm por corte).
+'''
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import pydicom
+from funciones_p1 import normalizar_matriz
+
+
+#TIPO DE LOS PÍXELES.
+def tipo_pixel(cabecera):
+    '''
+    Tipo de NumPy de la matriz de píxeles a partir de la cabecera (BitsAllocated y PixelRepresentation),
+    el mismo que devuelve pixel_array.
+    '''
+
+    if getattr(cabecera, 'SamplesPerPixel', 1) != 1:
+        raise ValueError('Solo se admiten imágenes en escala de grises.')
+
+    signo = 'int' if getattr(cabecera, 'PixelRepresentation', 0) == 1 else 'uint'
+    return np.dtype(signo + str(cabecera.BitsAllocated))
+
+
+#POSICIÓN DEL CORTE.
+def posicion_corte(cabecera):
+    '''
+    Posición del corte a lo largo de la normal de la imagen. Si la cabecera no tiene posición ni
+    orientación se usa el número de instancia.
+    '''
+
+    if 'ImagePositionPatient' in cabecera and 'ImageOrientationPatient' in cabecera:
+        orientacion = np.array(cabecera.ImageOrientationPatient, dtype=np.float64)
+        normal = np.cross(orientacion[:3], orientacion[3:]) #Normal al plano del corte.
+        return float(np.dot(normal, np.array(cabecera.ImagePositionPatient, dtype=np.float64)))
+
+    return float(getattr(cabecera, 'InstanceNumber', 0))
+
+
+#SERIE DICOM.
+class SerieDICOM:
+    '''
+    Serie DICOM con lectura perezosa de los píxeles.
+
+    Parámetros:
+        directorio : carpeta con los archivos .dcm de la serie.
+        hilos : número de hilos para leer cabeceras y decodificar cortes (None, los de Python por defecto).
+        memmap : ruta de un archivo .npy donde guardar el volumen en disco (None, en memoria).
+        precargar : si es True, se empiezan a decodificar todos los cortes en segundo plano.
+
+    Notas:
+        Al abrir la serie solo se leen las cabeceras (stop_before_pixels) y se ordenan los cortes por su
+        posición. El volumen (cortes, filas, columnas) se reserva una vez, en memoria o como memmap, y
+        cada corte se decodifica en el conjunto de hilos la primera vez que se pide. serie[k] devuelve
+        el corte k normalizado y serie.corte(k) el corte sin normalizar. Los cortes que nunca se piden
+        no se decodifican.
+    '''
+
+    def __init__(self, directorio, hilos=None, memmap=None, precargar=False):
+        archivos = sorted(os.path.join(directorio, nombre) for nombre in os.listdir(directorio)
+                          if nombre.lower().endswith('.dcm'))
+        if not archivos:
+            raise ValueError('No hay archivos .dcm en ' + str(directorio))
+
+        self._hilos = ThreadPoolExecutor(max_workers=hilos)
+        cabeceras = list(self._hilos.map(lambda archivo: pydicom.dcmread(archivo, stop_before_pixels=True),
+                                         archivos))
+
+        orden = sorted(range(len(archivos)), key=lambda k: posicion_corte(cabeceras[k]))
+        self.archivos = [archivos[k] for k in orden]
+        self.cabeceras = [cabeceras[k] for k in orden]
+
+        primera = self.cabeceras[0]
+        self.dimension = (len(self.archivos), int(primera.Rows), int(primera.Columns))
+        dtype = tipo_pixel(primera)
+
+        if memmap is None:
+            self.volumen = np.empty(self.dimension, dtype=dtype)
+        else:
+            self.volumen = np.lib.format.open_memmap(memmap, mode='w+', dtype=dtype, shape=self.dimension)
+
+        self._futuros = [None]*len(self.archivos) #Decodificación pedida de cada corte.
+        self._cerrojo = threading.Lock()
+
+        if precargar:
+            self.precargar()
+
+    def __len__(self):
+        return self.dimension[0]
+
+    def __getitem__(self, k):
+        return normalizar_matriz(self.corte(k))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.cerrar()
+
+    def _decodificar(self, k):
+        dataset = pydicom.dcmread(self.archivos[k])
+        self.volumen[k] = dataset.pixel_array
+
+    def _pedir(self, k):
+        with self._cerrojo:
+            if self._futuros[k] is None:
+                self._futuros[k] = self._hilos.submit(self._decodificar, k)
+            return self._futuros[k]
+
+    def precargar(self, cortes=None):
+        '''
+        Empieza a decodificar los cortes indicados (todos si es None) en segundo plano, sin esperar.
+        '''
+
+        indices = range(len(self)) if cortes is None else cortes
+        for k in indices:
+            self._pedir(k)
+
+    def corte(self, k):
+        '''
+        Matriz de píxeles del corte k (sin normalizar). Espera a que esté decodificado.
+        '''
+
+        if k < 0:
+            k += len(self)
+        self._pedir(k).result()
+
+        return self.volumen[k]
+
+    def volumen_completo(self):
+        '''
+        Volumen con todos los cortes decodificados (sin normalizar).
+        '''
+
+        self.precargar()
+        for futuro in wait(self._futuros).done:
+            futuro.result() #Se propagan los errores de lectura.
+
+        return self.volumen
+
+    def cerrar(self):
+        '''
+        Termina los hilos de lectura y, si el volumen es un memmap, lo guarda en disco.
+        '''
+
+        self._hilos.shutdown(wait=True)
+        if isinstance(self.volumen, np.memmap):
+            self.volumen.flush()
@@ -4,9 +4,44 @@ from matplotlib import pyplot as plt
 import pydicom
 import numpy as np
 import math
+import heapq
+from numba import njit, types
+from numba.typed import List
 from funciones_p2 import *
 
 
+#CRECIMIENTO DE UNA REGIÓN (BFS).
+@njit(cache=True)
+def crecer_region(img_norm, fila, col, inferior, superior, visitado, cola, matriz_cr):
+    '''
+    Búsqueda en anchura con vecindad a 8 desde la semilla (fila, col). Los píxeles con valor entre
+    inferior y superior (incluidos) se marcan con 1 en matriz_cr. visitado es una matriz booleana del
+    tamaño de la imagen (a False) y cola un vector de índices con un hueco por píxel. Devuelve el
+    número de píxeles de la región.
+    '''
+
+    filas, columnas = img_norm.shape
+    visitado[fila, col] = True
+    matriz_cr[fila, col] = 1
+    cola[0] = fila*columnas + col
+    inicio, fin = 0, 1 #Cabeza y final de la cola.
+
+    while inicio < fin:
+        c_fila, c_col = divmod(cola[inicio], columnas) #Píxel a centrar.
+        inicio += 1
+        for i in range(max(c_fila-1, 0), min(c_fila+2, filas)): #Filas.
+            for j in range(max(c_col-1, 0), min(c_col+2, columnas)): #Columnas.
+                if not visitado[i, j]:
+                    visitado[i, j] = True #Cada píxel se compara una sola vez.
+                    pixel = img_norm[i, j]
+                    if pixel >= inferior and pixel <= superior:
+                        matriz_cr[i, j] = 1
+                        cola[fin] = i*columnas + j
+                        fin += 1
+
+    return fin
+
+
 #SEGMENTACIÓN POR CRECIMIENTO DE REGIONES
 def RegionGrowingP2(img_norm, list_sem, umbral):
     '''
@@ -21,42 +56,309 @@ def RegionGrowingP2(img_norm, list_sem, umbral):
         matriz_cr : matriz de la imagen segmentada.
     
     Notas:
-        Se normaliza la imagen y se obtienen las coordenadas de la semilla. A continuación se crea
-        una matriz de ceros del tamaño de la imagen normalizada y se establece con valor 1 la coordenada 
-        donde se ha clicado. Se analizan los 8 vecinos iterativamente hasta que los píxeles no cumplan
-        la condición.
+        Se obtienen las coordenadas de la semilla y se crea una matriz de ceros del tamaño de la imagen
+        normalizada con valor 1 en la semilla. Se analizan los 8 vecinos iterativamente hasta que los
+        píxeles no cumplan la condición. Los píxeles ya comparados se guardan en una matriz booleana y
+        los pendientes en una cola de índices reservada de antemano, así que cada píxel se visita una
+        sola vez (coste lineal con el tamaño de la región).
     '''
     
     coord_sem = list_sem[0] #Coordenada de la semilla.
+    img_norm = np.ascontiguousarray(img_norm)
     matriz_cr = np.zeros(img_norm.shape) #Matriz de ceros del tamaño de la imagen normalizada.
-    matriz_cr[coord_sem[0]][coord_sem[1]] = 1 #Se establece como 1 la coordenada de la semilla.
-    pix_sem = img_norm[coord_sem[0]][coord_sem[1]] #Nivel de gris de la semilla.
-    
-    coord_homog = [] #Lista vacía.
-    coord_homog.append(coord_sem) #Se añaden a la lista las coordenadas de la semilla.
-    
-    ya_comparadas = [] #Lista vacía.
-    ya_comparadas.append(coord_sem) #Se añaden a la lista las coordenadas de la semilla.
-    
-    #Ejecución de instrucciones mientras se ejecuta la condición. 
-    while (len(coord_homog)!= 0):
-        coordenada = coord_homog.pop(0) #Coordenada de la lista que se ha eliminado, es el píxel a centrar.
-        for i in range(coordenada[0]-1, coordenada[0]+2): #Filas.
-            for j in range (coordenada[1]-1, coordenada[1]+2): #Columnas.
-            #Se cogen coordenadas con vecindad a 8 centradas en la semilla.
-                if ((0 <= i <= (img_norm.shape[0]-1)) and (0 <= j <= (img_norm.shape[1]-1))): 
-                    pixel = img_norm[i][j] #Valor de gris de cada pixel para comparar.
-                    c = (i,j) #Coordenada del píxel vecino.
-                
-                    if c not in ya_comparadas:
-                        ya_comparadas.append(c) #Se añade la coordenada a la lista.
-                        if (pixel >= (pix_sem - umbral)) and (pixel <= (pix_sem + umbral)):
-                        #En este if hay 3 condiciones:
-                            #1. Si el píxel pertenece al intervalo.
-                            #2. Si el píxel no está fuera de los límites de la imagen.
-                            #3. Si la coordenada del vecino NO está aún en ya_comparadas.
-                        
-                            matriz_cr[i][j] = 1 #Se manda a blanco el valor del píxel.
-                            coord_homog.append(c) #Se añade la coordenada a la lista.
+    pix_sem = img_norm[coord_sem[0], coord_sem[1]] #Nivel de gris de la semilla.
+    
+    visitado = np.zeros(img_norm.shape, dtype=np.bool_) #Píxeles ya comparados.
+    cola = np.empty(img_norm.size, dtype=np.int64) #Píxeles pendientes (índices planos).
+    crecer_region(img_norm, int(coord_sem[0]), int(coord_sem[1]), pix_sem - umbral, pix_sem + umbral,
+                  visitado, cola, matriz_cr)
                         
-    return matriz_cr
\ No newline at end of file
+    return matriz_cr
+
+
+#CRECIMIENTO DE VARIAS REGIONES A LA VEZ (BFS).
+@njit(cache=True)
+def crecer_regiones(img_norm, semillas, inferior, superior, etiquetas, distancia, cola):
+    '''
+    Búsqueda en anchura con vecindad a 8 desde todas las semillas a la vez, con una única cola. La
+    semilla k (fila, columna en semillas[k]) tiene la etiqueta k+1 y su propio intervalo
+    [inferior[k], superior[k]]. etiquetas y distancia son matrices del tamaño de la imagen (a 0) y
+    cola un vector de índices con un hueco por píxel.
+
+    Un píxel que no cumple el criterio de una región puede entrar después en otra. Si dos regiones
+    llegan a un píxel a la misma distancia (en pasos) de sus semillas, se queda la de menor etiqueta:
+    como la cola recorre la imagen por niveles, el píxel se reetiqueta antes de sacarlo de la cola.
+    '''
+
+    filas, columnas = img_norm.shape
+    fin = 0
+    for k in range(semillas.shape[0]):
+        fila, col = semillas[k, 0], semillas[k, 1]
+        if etiquetas[fila, col] == 0: #Si dos semillas coinciden, se queda la primera.
+            etiquetas[fila, col] = k + 1
+            cola[fin] = fila*columnas + col
+            fin += 1
+
+    inicio = 0
+    while inicio < fin:
+        c_fila, c_col = divmod(cola[inicio], columnas) #Píxel a centrar.
+        inicio += 1
+        etiqueta = etiquetas[c_fila, c_col]
+        d = distancia[c_fila, c_col] + 1
+        for i in range(max(c_fila-1, 0), min(c_fila+2, filas)): #Filas.
+            for j in range(max(c_col-1, 0), min(c_col+2, columnas)): #Columnas.
+                otra = etiquetas[i, j]
+                if otra != 0 and not (otra > etiqueta and distancia[i, j] == d):
+                    continue
+                pixel = img_norm[i, j]
+                if pixel >= inferior[etiqueta-1] and pixel <= superior[etiqueta-1]:
+                    etiquetas[i, j] = etiqueta
+                    if otra == 0: #Si solo se reetiqueta, ya está en la cola.
+                        distancia[i, j] = d
+                        cola[fin] = i*columnas + j
+                        fin += 1
+
+
+#SEGMENTACIÓN POR CRECIMIENTO DE VARIAS REGIONES
+def RegionGrowingEtiquetasP2(img_norm, list_sem, umbral):
+    '''
+    Segmentación por crecimiento de regiones desde todas las semillas en una sola pasada.
+    
+    Parámetros:
+        img_norm : matriz de la imagen normalizada.
+        list_sem : lista de coordenadas de las semillas.
+        umbral : valor determinante del rango de grises incluidos en el criterio de homogeneidad. Puede
+                 ser un número (el mismo para todas las semillas) o uno por semilla.
+        
+    Devuelve:
+        etiquetas : matriz int32 con 0 en el fondo y k+1 en la región de la semilla k.
+    
+    Notas:
+        Cada semilla tiene su propio criterio (su nivel de gris más/menos el umbral) y su región está
+        dentro de la que daría RegionGrowingP2 con esa semilla. Las regiones no se solapan: un píxel que
+        cumple varios criterios se queda en la región que llega antes (menos pasos desde su semilla) y,
+        a la misma distancia, en la de menor etiqueta, y las demás regiones no crecen a través de él.
+        Todas las regiones crecen a la vez desde una única cola, así que el coste es parecido al de una
+        sola región.
+    '''
+    
+    img_norm = np.ascontiguousarray(img_norm)
+    semillas = np.array([(int(coord[0]), int(coord[1])) for coord in list_sem], dtype=np.int64).reshape(-1, 2)
+    pix_sem = img_norm[semillas[:, 0], semillas[:, 1]] #Nivel de gris de cada semilla.
+    umbral = np.broadcast_to(umbral, pix_sem.shape)
+    
+    etiquetas = np.zeros(img_norm.shape, dtype=np.int32)
+    distancia = np.zeros(img_norm.shape, dtype=np.int32) #Pasos hasta la semilla de su región.
+    cola = np.empty(img_norm.size, dtype=np.int64) #Píxeles pendientes (índices planos).
+    crecer_regiones(img_norm, semillas, pix_sem - umbral, pix_sem + umbral, etiquetas, distancia, cola)
+    
+    return etiquetas
+
+
+#UMBRAL MÍNIMO DE CADA PÍXEL (PRIORITY FLOOD).
+@njit(cache=True)
+def inundar_umbral(img_norm, fila, col, mapa):
+    '''
+    Recorre la imagen desde la semilla (fila, col) con vecindad a 8, sacando siempre el píxel pendiente
+    de menor valor (cola de prioridad). El valor de cada píxel es el mayor |pixel - semilla| del
+    camino que lo une a la semilla, minimizado sobre todos los caminos. mapa (de tamaño la imagen,
+    a inf) se rellena con esos valores y con -inf en la semilla.
+    '''
+
+    filas, columnas = img_norm.shape
+    pix_sem = np.float64(img_norm[fila, col])
+    mapa[fila, col] = -np.inf
+    cola = [(-np.inf, fila*columnas + col)]
+
+    while len(cola) > 0:
+        valor, indice = heapq.heappop(cola) #Píxel pendiente de menor valor.
+        c_fila, c_col = divmod(indice, columnas)
+        for i in range(max(c_fila-1, 0), min(c_fila+2, filas)): #Filas.
+            for j in range(max(c_col-1, 0), min(c_col+2, columnas)): #Columnas.
+                if mapa[i, j] == np.inf:
+                    #Los píxeles salen de la cola en orden creciente, así que el primer camino que
+                    #llega a un píxel ya es el de menor valor.
+                    mapa[i, j] = max(valor, abs(np.float64(img_norm[i, j]) - pix_sem))
+                    heapq.heappush(cola, (mapa[i, j], i*columnas + j))
+
+
+#MAPA DE UMBRALES PARA EL CRECIMIENTO DE REGIONES
+def mapa_umbral_region(img_norm, coord_sem):
+    '''
+    Umbral mínimo con el que cada píxel entra en la región de una semilla.
+    
+    Parámetros:
+        img_norm : matriz de la imagen normalizada.
+        coord_sem : coordenadas (fila, columna) de la semilla.
+        
+    Devuelve:
+        mapa : matriz (float64) con el menor umbral con el que RegionGrowingP2 incluye cada píxel
+               (-inf en la semilla).
+    
+    Notas:
+        Un píxel entra en la región si hay un camino (vecindad a 8) desde la semilla en el que todos los
+        píxeles están a una distancia de gris de la semilla menor o igual que el umbral. El mapa se
+        calcula una vez por semilla con una inundación por prioridad (coste N log N) y después la
+        región de cualquier umbral se obtiene con RegionGrowingMapaP2, que es una sola comparación.
+    '''
+    
+    img_norm = np.ascontiguousarray(img_norm)
+    mapa = np.full(img_norm.shape, np.inf)
+    inundar_umbral(img_norm, int(coord_sem[0]), int(coord_sem[1]), mapa)
+    
+    return mapa
+
+
+#SEGMENTACIÓN CON EL MAPA DE UMBRALES
+def RegionGrowingMapaP2(mapa, umbral, out=None):
+    '''
+    Segmentación por crecimiento de regiones a partir del mapa de umbrales de una semilla.
+    
+    Parámetros:
+        mapa : matriz de mapa_umbral_region.
+        umbral : valor determinante del rango de grises incluidos en el criterio de homogeneidad.
+        out : matriz (float64, del tamaño del mapa) donde escribir el resultado (None, se crea).
+        
+    Devuelve:
+        matriz_cr : matriz de la imagen segmentada (1 en la región y 0 fuera).
+    
+    Notas:
+        Es la misma región que RegionGrowingP2 con esa semilla y ese umbral, salvo en píxeles cuya
+        distancia de gris a la semilla es igual al umbral, donde el redondeo puede dar otro resultado.
+        Con out se puede mover el umbral (por ejemplo, con un deslizador) sin crear matrices nuevas.
+    '''
+    
+    if out is None:
+        out = np.empty(mapa.shape)
+    
+    return np.less_equal(mapa, umbral, out=out)
+
+
+#VECINOS 3D.
+def desplazamientos_3d(conectividad):
+    '''
+    Desplazamientos (corte, fila, columna) de los vecinos de un vóxel con conectividad 6 (caras),
+    18 (caras y aristas) o 26 (caras, aristas y vértices).
+    '''
+
+    if conectividad not in (6, 18, 26):
+        raise ValueError("'conectividad' debe ser 6, 18 o 26.")
+
+    rango = (-1, 0, 1)
+    desplazamientos = [(a, b, c) for a in rango for b in rango for c in rango
+                       if 0 < abs(a) + abs(b) + abs(c) <= {6: 1, 18: 2, 26: 3}[conectividad]]
+
+    return np.array(desplazamientos, dtype=np.int64)
+
+
+#CRECIMIENTO DE UNA REGIÓN 3D POR BLOQUES.
+@njit(cache=True)
+def crecer_region_3d(volumen, semilla, inferior, superior, desplazamientos, espaciado, radio2,
+                     max_voxeles, bloque, visitado, region):
+    '''
+    Crecimiento desde la semilla (corte, fila, columna) por los vecinos de desplazamientos. Entran en
+    la región los vóxeles con valor entre inferior y superior cuya distancia física a la semilla al
+    cuadrado no supera radio2. visitado y region son mapas de bits (un bit por vóxel, en orden plano).
+    Los vóxeles pendientes se guardan en una pila por bloque de cortes y se termina un bloque antes de
+    pasar al siguiente, así que se trabaja sobre pocos cortes a la vez (útil si volumen es un memmap).
+    Se para al llegar a max_voxeles. Devuelve el número de vóxeles de la región.
+    '''
+
+    cortes, filas, columnas = volumen.shape
+    plano = filas*columnas
+    n_bloques = (cortes + bloque - 1)//bloque
+    pendientes = [List.empty_list(types.int64) for b in range(n_bloques)] #Una pila de índices planos por bloque.
+
+    z0, y0, x0 = semilla[0], semilla[1], semilla[2]
+    indice = (z0*filas + y0)*columnas + x0
+    visitado[indice >> 3] |= np.uint8(1 << (indice & 7))
+    region[indice >> 3] |= np.uint8(1 << (indice & 7))
+    pendientes[z0//bloque].append(indice)
+    n_voxeles = 1
+    actual = z0//bloque
+
+    while actual >= 0 and n_voxeles < max_voxeles:
+        pila = pendientes[actual]
+        while len(pila) > 0 and n_voxeles < max_voxeles:
+            z, resto = divmod(pila.pop(), plano)
+            y, x = divmod(resto, columnas)
+            for d in range(desplazamientos.shape[0]):
+                zz, yy, xx = z + desplazamientos[d, 0], y + desplazamientos[d, 1], x + desplazamientos[d, 2]
+                if zz < 0 or zz >= cortes or yy < 0 or yy >= filas or xx < 0 or xx >= columnas:
+                    continue
+                vecino = (zz*filas + yy)*columnas + xx
+                bit = np.uint8(1 << (vecino & 7))
+                if visitado[vecino >> 3] & bit:
+                    continue
+                visitado[vecino >> 3] |= bit #Cada vóxel se compara una sola vez.
+
+                distancia2 = (((zz - z0)*espaciado[0])**2 + ((yy - y0)*espaciado[1])**2
+                              + ((xx - x0)*espaciado[2])**2)
+                voxel = volumen[zz, yy, xx]
+                if distancia2 <= radio2 and voxel >= inferior and voxel <= superior:
+                    region[vecino >> 3] |= bit
+                    pendientes[zz//bloque].append(vecino)
+                    n_voxeles += 1
+                    if n_voxeles >= max_voxeles:
+                        break
+
+        actual = -1 #Siguiente bloque con vóxeles pendientes.
+        for b in range(n_bloques):
+            if len(pendientes[b]) > 0:
+                actual = b
+                break
+
+    return n_voxeles
+
+
+#SEGMENTACIÓN 3D POR CRECIMIENTO DE REGIONES
+def RegionGrowing3D(volumen, coord_sem, umbral, conectividad=26, espaciado=(1.0, 1.0, 1.0),
+                    radio_max=None, max_voxeles=None, bloque=16, empaquetado=False):
+    '''
+    Segmentación por crecimiento de regiones en un volumen.
+    
+    Parámetros:
+        volumen : volumen (cortes x filas x columnas), normalizado o no. Puede ser un memmap (por
+                  ejemplo, el de SerieDICOM).
+        coord_sem : coordenadas (corte, fila, columna) de la semilla.
+        umbral : valor determinante del rango de grises incluidos en el criterio de homogeneidad.
+        conectividad : 6, 18 o 26 vecinos.
+        espaciado : tamaño del vóxel (corte, fila, columna), por ejemplo en mm.
+        radio_max : distancia máxima a la semilla, en las unidades de espaciado (None, sin límite).
+        max_voxeles : número máximo de vóxeles de la región (None, sin límite).
+        bloque : número de cortes que se procesan juntos.
+        empaquetado : si es True, la región se devuelve como mapa de bits (np.packbits, bitorder='little').
+        
+    Devuelve:
+        region : matriz booleana del tamaño del volumen (o mapa de bits) con la región segmentada.
+        n_voxeles : número de vóxeles de la región.
+    
+    Notas:
+        El criterio es el mismo que en RegionGrowingP2: el vóxel está entre el gris de la semilla
+        menos y más el umbral. Los vóxeles visitados y los de la región se guardan en mapas de bits (un
+        bit por vóxel) y los pendientes en una pila por bloque de cortes, así que la memoria extra es
+        pequeña y el volumen se lee por bloques. Sin max_voxeles el resultado no depende del orden de
+        recorrido; con max_voxeles se devuelven los primeros vóxeles encontrados.
+    '''
+    
+    if volumen.ndim != 3:
+        raise ValueError("'volumen' debe ser una matriz 3D.")
+    
+    semilla = np.array([int(c) for c in coord_sem], dtype=np.int64)
+    pix_sem = np.float64(volumen[semilla[0], semilla[1], semilla[2]]) #Nivel de gris de la semilla (float64 para no desbordar enteros).
+    desplazamientos = desplazamientos_3d(conectividad)
+    radio2 = np.inf if radio_max is None else float(radio_max)**2
+    if max_voxeles is None:
+        max_voxeles = volumen.size
+    
+    n_bytes = (volumen.size + 7)//8
+    visitado = np.zeros(n_bytes, dtype=np.uint8) #Vóxeles ya comparados (un bit por vóxel).
+    region = np.zeros(n_bytes, dtype=np.uint8) #Vóxeles de la región (un bit por vóxel).
+    n_voxeles = crecer_region_3d(volumen, semilla, pix_sem - umbral, pix_sem + umbral, desplazamientos,
+                                 np.asarray(espaciado, dtype=np.float64), radio2, int(max_voxeles),
+                                 int(bloque), visitado, region)
+    
+    if not empaquetado:
+        region = np.unpackbits(region, count=volumen.size, bitorder='little').view(np.bool_).reshape(volumen.shape)
+    
+    return region, n_voxeles
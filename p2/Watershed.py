@@ -3,12 +3,36 @@ from matplotlib import pyplot as plt
 import pydicom
 import numpy as np
 import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import skimage
 from skimage import filters
 from skimage.segmentation import watershed
 from funciones_p2 import *
 from imimposemin import *
 
+
+SALIDAS_WATERSHED = ('imimposemin', 'sobel') #Resultados que puede calcular WatershedLote.
+
+
+#IMAGEN DE MARCADORES.
+def imagen_marcadores(forma, coord_sem, out=None):
+    '''
+    Matriz binaria del tamaño forma con 1 en las coordenadas de las semillas (lista de (fila, columna))
+    y 0 en el resto. Si se da out, se escribe en ella.
+    '''
+
+    if out is None:
+        out = np.zeros(forma) #Matriz de ceros del tamaño de la imagen.
+    else:
+        out[...] = 0
+
+    coords = np.asarray(coord_sem, dtype=np.intp).reshape(-1, 2)
+    out[coords[:, 0], coords[:, 1]] = 1 #Se establecen como 1 todas las semillas a la vez.
+
+    return out
+
+
 def WatershedExerciseP2(imagen_normalizada, imagen_sobel, coord_sem): 
     '''
     Adición de ruido gaussiano.
@@ -30,13 +54,7 @@ def WatershedExerciseP2(imagen_normalizada, imagen_sobel, coord_sem):
         y sobel). Por último, se muestra en pantalla el resultado de la función imimposemin sobre la imagen normalizada y la binaria. 
     '''
 
-    img_binaria = np.zeros(imagen_normalizada.shape) #Matriz de ceros del tamaño de la imagen de entrada.
-
-    for elem in range (len(coord_sem)):
-        coord = coord_sem[elem] #Coordenada i de la lista
-        fila = coord[0] #Fila
-        col = coord[1] #Columna
-        img_binaria[fila][col] = 1 #Se establece como 1 la coordenada de la semilla.
+    img_binaria = imagen_marcadores(imagen_normalizada.shape, coord_sem) #1 en las semillas y 0 en el resto.
         
     min_loc = imimposemin(imagen_sobel, img_binaria) #Mínimos locales 
     img_ws1 = watershed(min_loc) #Watershed con imimposemin
@@ -47,4 +65,109 @@ def WatershedExerciseP2(imagen_normalizada, imagen_sobel, coord_sem):
     plt.imshow(min_norm,cmap=pylab.cm.gray) #Alpha para visualización de la máscara generada sobre la imagen original.
     plt.title('IMIMPOSEMIN en NORMALIZADA')
 
-    return img_ws1, img_ws2
\ No newline at end of file
+    return img_ws1, img_ws2
+
+
+#WATERSHED DE UN CORTE.
+def watershed_corte(imagen_sobel, coord_sem, salidas=('imimposemin',)):
+    '''
+    Watershed de un corte sin mostrar nada.
+    
+    Parámetros:
+        imagen_sobel : matriz de píxeles de la imagen con filtro de sobel.
+        coord_sem : lista con las coordenadas de las semillas.
+        salidas : resultados a calcular, 'imimposemin' (watershed tras imponer los mínimos en las
+                  semillas) y/o 'sobel' (watershed directo sobre la imagen de sobel).
+        
+    Devuelve:
+        resultados : diccionario {salida: matriz de etiquetas}.
+    '''
+    
+    resultados = {}
+    if 'imimposemin' in salidas:
+        min_loc = imimposemin(imagen_sobel, imagen_marcadores(imagen_sobel.shape, coord_sem)) #Mínimos locales
+        resultados['imimposemin'] = watershed(min_loc)
+    if 'sobel' in salidas:
+        resultados['sobel'] = watershed(imagen_sobel)
+    
+    return resultados
+
+
+def watershed_compartido(nombre_pila, forma, dtype, nombres_salida, k, coord_sem):
+    '''
+    Tarea de WatershedLote: calcula el corte k de la pila en memoria compartida nombre_pila y escribe
+    cada resultado en el corte k de su pila de salida (int32) en memoria compartida.
+    '''
+    
+    memorias = {salida: shared_memory.SharedMemory(name=nombre) for salida, nombre in nombres_salida.items()}
+    memoria_pila = shared_memory.SharedMemory(name=nombre_pila)
+    try:
+        imagen_sobel = np.ndarray(forma, dtype=dtype, buffer=memoria_pila.buf)[k]
+        resultados = watershed_corte(imagen_sobel, coord_sem, tuple(memorias))
+        for salida, etiquetas in resultados.items():
+            pila_salida = np.ndarray(forma, dtype=np.int32, buffer=memorias[salida].buf)
+            pila_salida[k] = etiquetas
+            del pila_salida
+        del imagen_sobel #Sin vistas abiertas para poder cerrar la memoria.
+    finally:
+        memoria_pila.close()
+        for memoria in memorias.values():
+            memoria.close()
+
+
+#WATERSHED DE UNA PILA DE CORTES.
+def WatershedLote(pila_sobel, marcadores, salidas=('imimposemin',), procesos=None):
+    '''
+    Watershed de una pila de cortes en paralelo y sin figuras.
+    
+    Parámetros:
+        pila_sobel : pila (cortes x filas x columnas) de imágenes con filtro de sobel.
+        marcadores : lista con la lista de coordenadas de las semillas de cada corte.
+        salidas : resultados a calcular ('imimposemin' y/o 'sobel', ver watershed_corte).
+        procesos : número de procesos (None, uno por CPU; 1, sin procesos).
+        
+    Devuelve:
+        resultados : diccionario {salida: pila int32 de etiquetas (cortes x filas x columnas)}.
+    
+    Notas:
+        Solo se calculan las salidas pedidas, sin el imimposemin de la imagen normalizada ni la figura
+        de WatershedExerciseP2. La pila de entrada y las de salida se guardan en memoria compartida,
+        así que cada proceso lee su corte y escribe sus etiquetas sin copiar las pilas.
+    '''
+    
+    salidas = tuple(salidas)
+    if not salidas or any(salida not in SALIDAS_WATERSHED for salida in salidas):
+        raise ValueError("'salidas' debe contener 'imimposemin' y/o 'sobel'.")
+    pila_sobel = np.asarray(pila_sobel)
+    if pila_sobel.ndim != 3 or len(marcadores) != pila_sobel.shape[0]:
+        raise ValueError("'pila_sobel' debe ser una pila 3D con una lista de semillas por corte.")
+    
+    forma = pila_sobel.shape
+    if procesos == 1 or forma[0] == 1: #Sin procesos.
+        resultados = {salida: np.empty(forma, dtype=np.int32) for salida in salidas}
+        for k in range(forma[0]):
+            for salida, etiquetas in watershed_corte(pila_sobel[k], marcadores[k], salidas).items():
+                resultados[salida][k] = etiquetas
+        return resultados
+    
+    n_bytes = pila_sobel.size*np.dtype(np.int32).itemsize
+    memoria_pila = shared_memory.SharedMemory(create=True, size=max(pila_sobel.nbytes, 1))
+    memorias = {salida: shared_memory.SharedMemory(create=True, size=max(n_bytes, 1)) for salida in salidas}
+    try:
+        np.ndarray(forma, dtype=pila_sobel.dtype, buffer=memoria_pila.buf)[...] = pila_sobel
+        nombres_salida = {salida: memoria.name for salida, memoria in memorias.items()}
+        
+        with ProcessPoolExecutor(max_workers=procesos) as procesador:
+            tareas = [procesador.submit(watershed_compartido, memoria_pila.name, forma, pila_sobel.dtype,
+                                        nombres_salida, k, marcadores[k]) for k in range(forma[0])]
+            for tarea in tareas:
+                tarea.result() #Se propagan los errores de los procesos.
+        
+        resultados = {salida: np.ndarray(forma, dtype=np.int32, buffer=memoria.buf).copy()
+                      for salida, memoria in memorias.items()}
+    finally:
+        for memoria in [memoria_pila] + list(memorias.values()):
+            memoria.close()
+            memoria.unlink()
+    
+    return resultados
\ No newline at end of file
@@ -0,0 +1,226 @@
+'''
+Motor del filtro anisotrópico (anisotropico de funciones_p1 y funciones_p2).
+'''
+
+import numpy as np
+import skimage
+from skimage import filters
+from numba import njit, prange
+
+
+#PADDING SIN RESERVAR MEMORIA.
+def rellenar_padding(imagen, img_padding):
+    '''
+    Copia la imagen en img_padding (con un píxel de borde) repitiendo los bordes, igual que
+    pad(imagen, (1,1), 'edge') pero sobre una matriz ya creada.
+    '''
+
+    img_padding[1:-1, 1:-1] = imagen
+    img_padding[0, 1:-1] = imagen[0] #Borde superior.
+    img_padding[-1, 1:-1] = imagen[-1] #Borde inferior.
+    img_padding[:, 0] = img_padding[:, 1] #Borde izquierdo (con esquinas).
+    img_padding[:, -1] = img_padding[:, -2] #Borde derecho (con esquinas).
+
+
+#MEDIA 3x3 CON UMBRAL - NUMBA.
+@njit(parallel=True, cache=True)
+def media_umbral_numba(img_padding, img_sobel, umbral, img_anisotropico):
+    '''
+    Sustituye por la media de su parche 3x3 cada píxel cuyo gradiente no supera el umbral.
+    La suma del parche se hace en el mismo orden que np.mean (suma por parejas de los 8 primeros
+    elementos y después el noveno), así que el resultado es idéntico.
+    '''
+
+    for i in prange(img_sobel.shape[0]): #Filas.
+        for j in range(img_sobel.shape[1]): #Columnas.
+            if not img_sobel[i, j] > umbral:
+                p = img_padding
+                suma = (((p[i, j] + p[i, j+1]) + (p[i, j+2] + p[i+1, j]))
+                        + ((p[i+1, j+1] + p[i+1, j+2]) + (p[i+2, j] + p[i+2, j+1])))
+                suma += p[i+2, j+2]
+                img_anisotropico[i, j] = suma/9 #Media del parche.
+
+
+#PRIMERA ITERACIÓN - NUMBA.
+def primera_media_numba(imagen, img_sobel, umbral, img_anisotropico, img_padding):
+    '''
+    Primera iteración de media_umbral_numba, sobre la imagen con ruido. Si la imagen es float32 las
+    medias se calculan en float32 (como np.mean sobre la imagen original) y se guardan en
+    img_anisotropico, que es float64. img_padding queda con la imagen original.
+    '''
+
+    rellenar_padding(img_anisotropico, img_padding)
+    if np.asarray(imagen).dtype == np.float32: #np.mean suma en el tipo de la imagen.
+        primera = np.array(imagen, dtype=np.float32)
+        media_umbral_numba(img_padding.astype(np.float32), img_sobel, umbral, primera)
+        img_anisotropico[...] = primera
+    else:
+        media_umbral_numba(img_padding, img_sobel, umbral, img_anisotropico)
+
+
+#GRADIENTE Y MEDIA DE UN PÍXEL.
+@njit(cache=True)
+def gradiente_media_pixel(img, i, j):
+    '''
+    Gradiente de Sobel (como skimage.filters.sobel, con bordes repetidos) y media 3x3 del píxel (i, j).
+    Solo se leen los 8 vecinos, sin padding.
+    '''
+
+    filas, columnas = img.shape
+    i0, i1 = max(i-1, 0), min(i+1, filas-1) #Fila anterior y siguiente (con borde repetido).
+    j0, j1 = max(j-1, 0), min(j+1, columnas-1) #Columna anterior y siguiente (con borde repetido).
+
+    a, b, c = img[i0, j0], img[i0, j], img[i0, j1]
+    d, e, f = img[i, j0], img[i, j], img[i, j1]
+    g, h, k = img[i1, j0], img[i1, j], img[i1, j1]
+
+    grad_filas = ((a + 2*b + c) - (g + 2*h + k))/4
+    grad_columnas = ((a + 2*d + g) - (c + 2*f + k))/4
+    gradiente = np.sqrt((grad_filas**2 + grad_columnas**2)/2)
+
+    suma = (((a + b) + (c + d)) + ((e + f) + (g + h))) + k #Mismo orden que media_umbral_numba.
+
+    return gradiente, suma/9
+
+
+#ITERACIONES SOBRE LOS PÍXELES ACTIVOS.
+@njit(cache=True)
+def iteraciones_activas(img_anisotropico, umbral, iteraciones, tolerancia, activos, n_activos):
+    '''
+    Repite el filtro solo sobre los píxeles activos (índices planos en activos[:n_activos]), es decir,
+    los que tienen algún vecino 3x3 que cambió en la iteración anterior. El resto no puede cambiar.
+    Se para cuando no queda ningún cambio mayor que la tolerancia. Devuelve las iteraciones hechas.
+    '''
+
+    filas, columnas = img_anisotropico.shape
+    n_pixeles = filas*columnas
+    img_plana = img_anisotropico.ravel()
+    cambiados = np.empty(n_pixeles, dtype=np.int64) #Píxeles que cambian en la iteración.
+    valores = np.empty(n_pixeles) #Nuevo valor de cada píxel cambiado.
+    vecindad = np.zeros((filas, columnas), dtype=np.uint8) #Píxeles activos de la siguiente iteración.
+    vecindad_plana = vecindad.ravel()
+
+    for contador in range(iteraciones):
+        n_cambiados = 0
+        for k in range(n_activos):
+            i, j = divmod(activos[k], columnas)
+            gradiente, media = gradiente_media_pixel(img_anisotropico, i, j)
+            if not gradiente > umbral and np.abs(media - img_anisotropico[i, j]) > tolerancia:
+                cambiados[n_cambiados] = activos[k]
+                valores[n_cambiados] = media
+                n_cambiados += 1
+
+        if n_cambiados == 0: #La imagen ya no cambia.
+            return contador
+
+        for c in range(n_cambiados): #Se actualiza después de calcular todas las medias.
+            img_plana[cambiados[c]] = valores[c]
+
+        for c in range(n_cambiados): #Se marcan los vecinos 3x3 de los píxeles cambiados.
+            i, j = divmod(cambiados[c], columnas)
+            vecindad[max(i-1, 0):i+2, max(j-1, 0):j+2] = 1
+
+        n_activos = 0 #Se recogen en orden, para recorrer la imagen por filas.
+        for k in range(n_pixeles):
+            if vecindad_plana[k]:
+                vecindad_plana[k] = 0
+                activos[n_activos] = k
+                n_activos += 1
+
+    return iteraciones
+
+
+#MEDIA 3x3 CON UMBRAL - VECTORIZADA.
+def media_umbral_vectorizada(img_padding, img_sobel, umbral, img_anisotropico, suma_filas, media):
+    '''
+    Igual que media_umbral_numba, pero con la media 3x3 calculada como filtro separable (suma de 3 filas
+    y después de 3 columnas) y una única selección vectorizada. suma_filas y media son matrices de
+    trabajo de tamaño (filas, columnas+2) y (filas, columnas). Coincide con np.mean salvo redondeo.
+    '''
+
+    np.add(img_padding[:-2], img_padding[1:-1], out=suma_filas) #Suma de 3 filas.
+    suma_filas += img_padding[2:]
+    np.add(suma_filas[:, :-2], suma_filas[:, 1:-1], out=media) #Suma de 3 columnas.
+    media += suma_filas[:, 2:]
+    media /= 9
+
+    np.copyto(img_anisotropico, media, where=np.logical_not(img_sobel > umbral))
+
+
+#FILTRO ANISOTRÓPICO.
+def filtro_anisotropico(imagen, umbral, iteraciones, modo='numba', tolerancia=0.0):
+    '''
+    Filtro anisotrópico.
+
+    Parámetros:
+        imagen : matriz de píxeles normalizada con ruido.
+        umbral : parámetro a comparar con el gradiente.
+        iteraciones : número de veces que pasa la imagen por el filtro.
+        modo : 'numba' (resultado idéntico al de la versión original), 'vectorizado' (solo NumPy) o
+               'activo' (solo se recalculan los píxeles que todavía pueden cambiar).
+        tolerancia : en modo 'activo', cambios iguales o menores que este valor no se aplican.
+
+    Devuelve:
+        img_anisotropico : matriz de píxeles de la imagen filtrada con el filtro anisotrópico.
+
+    Notas:
+        En cada iteración se calcula el gradiente (Sobel) de la imagen y los píxeles cuyo gradiente no
+        supera el umbral se sustituyen por la media de su parche 3x3. Todas las medias se calculan sobre
+        la imagen de la iteración anterior (con padding), así que el orden en el que se recorren los
+        píxeles no cambia el resultado. El padding y las matrices de trabajo se crean una sola vez. Como
+        en la versión original, la primera iteración de una imagen float32 promedia en float32 y las
+        siguientes en float64.
+
+        El nuevo valor de un píxel solo depende de su parche 3x3, así que a partir de la segunda iteración
+        solo puede cambiar un píxel que tenga algún vecino que haya cambiado. En modo 'activo' la primera
+        iteración es igual que en modo 'numba' y en las siguientes solo se recalculan el gradiente y la
+        media de esos píxeles. El filtro se para antes si ningún píxel cambia más que la tolerancia. Con
+        tolerancia 0 el resultado es el mismo salvo el redondeo del gradiente.
+    '''
+
+    if modo not in ('numba', 'vectorizado', 'activo'):
+        raise ValueError("'modo' debe ser 'numba', 'vectorizado' o 'activo'.")
+
+    img_anisotropico = np.array(imagen, dtype=np.float64) #Copia de la imagen con ruido.
+    filas, columnas = img_anisotropico.shape
+    img_padding = np.empty((filas+2, columnas+2))
+
+    if modo == 'vectorizado':
+        suma_filas = np.empty((filas, columnas+2))
+        media = np.empty((filas, columnas))
+
+    if modo == 'activo' and iteraciones > 0:
+        img_sobel = skimage.filters.sobel(imagen) #Primera iteración completa.
+        primera_media_numba(imagen, img_sobel, umbral, img_anisotropico, img_padding)
+
+        cambio = np.zeros((filas+2, columnas+2), dtype=bool) #Píxeles cambiados (con borde).
+        cambio[1:-1, 1:-1] = img_anisotropico != img_padding[1:-1, 1:-1]
+        vecindad = np.zeros((filas, columnas), dtype=bool) #Píxeles con algún vecino cambiado.
+        for a in range(3):
+            for b in range(3):
+                vecindad |= cambio[a:a+filas, b:b+columnas]
+
+        activos = np.empty(filas*columnas, dtype=np.int64)
+        n_activos = np.count_nonzero(vecindad)
+        activos[:n_activos] = np.flatnonzero(vecindad)
+        iteraciones_activas(img_anisotropico, umbral, iteraciones-1, tolerancia, activos, n_activos)
+
+        return img_anisotropico
+
+    for contador in range(iteraciones):
+        if contador == 0: #Gradiente de la imagen con ruido.
+            img_sobel = skimage.filters.sobel(imagen)
+        else: #Gradiente de la imagen filtrada.
+            img_sobel = skimage.filters.sobel(img_anisotropico)
+
+        if modo == 'numba' and contador == 0:
+            primera_media_numba(imagen, img_sobel, umbral, img_anisotropico, img_padding)
+            continue
+        rellenar_padding(img_anisotropico, img_padding)
+
+        if modo == 'numba':
+            media_umbral_numba(img_padding, img_sobel, umbral, img_anisotropico)
+        else:
+            media_umbral_vectorizada(img_padding, img_sobel, umbral, img_anisotropico, suma_filas, media)
+
+    return img_anisotropico
@@ -4,9 +4,8 @@ from matplotlib import pyplot as plt
 import pydicom
 import numpy as np
 import math
-import skimage
-from skimage import filters
-from skimage.util import pad
+from numba import njit
+from filtro_anisotropico import filtro_anisotropico
 
 
 #NORMALIZACIÓN.
@@ -21,38 +20,100 @@ def normalizar(imagen):
         matriz_norm : matriz de píxeles de la imagen normalizada (valores entre 0 y 1).
     
     Notas:
-        Se lee el archivo y se extrae la matriz de píxeles. Si hay algún píxel con valor negativo, 
-        se le suma el mínimo valor de la imagen, haciendo así que toda la matriz tenga valores positivos.
-        Por último, para que dichas intensidades de píxel estén comprendidas entre 0 y 1, se divide 
-        cada píxel entre el máximo valor de la matriz.
+        Se lee el archivo, se extrae la matriz de píxeles y se normaliza con normalizar_matriz.
     '''
     
     dataset = pydicom.dcmread(imagen)
     matriz_pixel = dataset.pixel_array #Matriz de píxeles.
-    valor_min = np.amin(matriz_pixel) #Valor mínimo de píxel en esta matriz.
+    matriz_norm = normalizar_matriz(matriz_pixel, dtype=np.float64)
 
-    #Normalización en 2 pasos.
-    if valor_min < 0: #Si la matriz tiene algún valor negativo. 
+    return matriz_norm
+
+
+#MÍNIMO Y MÁXIMO EN UNA PASADA.
+@njit(cache=True)
+def min_max(matriz):
+    '''
+    Valor mínimo y máximo de la matriz, recorriéndola una sola vez.
+    '''
+
+    valor_min = np.inf
+    valor_max = -np.inf
+    for valor in matriz.flat:
+        if valor < valor_min:
+            valor_min = valor
+        if valor > valor_max:
+            valor_max = valor
+
+    return valor_min, valor_max
+
+
+#NORMALIZACIÓN DE UNA MATRIZ DE PÍXELES.
+def normalizar_matriz(matriz_pixel, dtype=np.float32, modo='corte', out=None, ventana=None, pendiente=1, intercepto=0):
+    '''
+    Normalización de una matriz de píxeles o de una pila de cortes.
+    
+    Parámetros:
+        matriz_pixel : matriz de píxeles de la imagen (filas x columnas) o pila (cortes x filas x columnas).
+        dtype : tipo de la matriz normalizada si no se da out.
+        modo : 'corte' (cada corte de la pila con su mínimo y máximo) o 'global' (toda la pila a la vez).
+        out : matriz donde se escribe el resultado. Puede ser la propia matriz_pixel si es de tipo float.
+        ventana : tupla (centro, anchura) de la ventana DICOM. Si se da, se usa en lugar del mínimo y máximo.
+        pendiente, intercepto : RescaleSlope y RescaleIntercept del DICOM (para pasar a unidades Hounsfield).
         
-        #PAS0 1: Sumamos el valor mínimo a cada elemento de la matriz.
-        matriz_valormin = -(valor_min)*np.ones(matriz_pixel.shape)
-        matriz_suma = matriz_pixel + matriz_valormin #Pixels de la matriz positivos.
+    Devuelve:
+        matriz_norm : matriz de píxeles de la imagen normalizada (valores entre 0 y 1).
+    
+    Notas:
+        Todo se calcula sobre la matriz de salida, sin matrices intermedias del tamaño de la imagen. 
+        Primero se copia la matriz en el tipo pedido y se aplican pendiente e intercepto. Con ventana, los
+        valores de [centro - anchura/2, centro + anchura/2] se llevan a [0, 1] y el resto se recorta.
+        Sin ventana, el mínimo y el máximo se buscan en una sola pasada. Si hay algún píxel con valor 
+        negativo, se le suma el mínimo valor de la imagen, haciendo así que toda la matriz tenga valores 
+        positivos. Por último, para que dichas intensidades de píxel estén comprendidas entre 0 y 1, se 
+        divide cada píxel entre el máximo valor de la matriz. Una imagen con máximo 0 se deja a 0.
+    '''
 
-        #PASO 2: Dividimos cada píxel de la matriz entre su máximo valor.
-        valor_max = np.amax(matriz_suma) 
-        matriz_norm = (1/valor_max)*matriz_suma #Valores de píxel entre 0 y 1.
+    if modo not in ('corte', 'global'):
+        raise ValueError("'modo' debe ser 'corte' o 'global'.")
 
-    else: 
-        #Dividimos cada píxel de la matriz entre su máximo valor.
-        valor_max = np.amax(matriz_pixel)
-        matriz_norm = (1/valor_max)*matriz_pixel #Valores de píxel entre 0 y 1.
+    matriz_norm = np.empty(matriz_pixel.shape, dtype=dtype) if out is None else out
+    np.copyto(matriz_norm, matriz_pixel, casting='unsafe')
+    tipo = matriz_norm.dtype.type
+
+    if pendiente != 1 or intercepto != 0: #Valores en unidades del DICOM.
+        matriz_norm *= pendiente
+        matriz_norm += intercepto
+
+    if ventana is not None:
+        centro, anchura = ventana
+        matriz_norm -= centro - anchura/2 #Inicio de la ventana en 0.
+        matriz_norm *= 1/anchura #Final de la ventana en 1.
+        np.clip(matriz_norm, 0, 1, out=matriz_norm)
+        return matriz_norm
+
+    if modo == 'corte' and matriz_norm.ndim == 3:
+        partes = list(matriz_norm) #Cada corte por separado (vistas, sin copias).
+    else:
+        partes = [matriz_norm]
+
+    for parte in partes:
+        valor_min, valor_max = min_max(parte) #Valores mínimo y máximo de píxel en esta matriz.
+
+        #Normalización en 2 pasos.
+        if valor_min < 0: #Si la matriz tiene algún valor negativo.
+            parte += -(valor_min) #PASO 1: Pixels de la matriz positivos.
+            valor_max = tipo(valor_max) + tipo(-(valor_min)) #Máximo después de sumar.
+
+        if valor_max != 0: #PASO 2: Dividimos cada píxel de la matriz entre su máximo valor.
+            parte *= 1/valor_max #Valores de píxel entre 0 y 1.
 
     return matriz_norm
 
 
 
 #FILTRO ANISOTRÓPICO
-def anisotropico(imagen, umbral, iteraciones):
+def anisotropico(imagen, umbral, iteraciones, modo='numba', tolerancia=0.0):
     '''
     Filtro anisotrópico.
     
@@ -60,6 +121,8 @@ def anisotropico(imagen, umbral, iteraciones):
         imagen : matriz de píxeles normalizada con ruido. 
         umbral : parámetro a comparar con el gradiente. 
         iteraciones : número de veces que pasa la imagen por el filtro. 
+        modo : 'numba' (mismo resultado que la versión con bucles), 'vectorizado' o 'activo'.
+        tolerancia : en modo 'activo', cambio mínimo para seguir iterando sobre un píxel.
         
     Devuelve:
         img_anisotropico : matriz de píxeles de la imagen filtrada con el filtro anisotrópico. 
@@ -68,43 +131,9 @@ def anisotropico(imagen, umbral, iteraciones):
         Se coge una imagen con ruido y se calcula el gradiente de cada píxel, con una máscara de Sobel. 
         A continuación, se compara cada gradiente con un umbral deseado y en función del valor, 
         se pasa el píxel a través de un filtro de media o se mantiene. El proceso se realiza varias veces. 
+        El cálculo se hace en filtro_anisotropico.
     '''
     
-    contador = 0 #Contador de iteraciones.
-    img_sobel = skimage.filters.sobel(imagen) #Filtro derivativo (Máscara Sobel).
-    img_padding = pad(imagen, (1,1), 'edge') #Imagen ruidosa con padding. 
-
-    while contador < iteraciones: 
-        if contador == 0: #Coge la imagen con ruido.
-            
-            img_anisotropico = np.ones(imagen.shape) #Matriz de 1. 
-        
-            for i in range(img_sobel.shape[0]): #Itera la matriz de la imagen de Sobel - Filas.
-                for j in range(img_sobel.shape[1]): #Itera la matriz de la imagen de Sobel - Columnas.
-        
-                    if img_sobel[i][j] > umbral: #Gradiente de cada pixel ruidoso (se encuentra en la img_sobel).
-                        img_anisotropico[i][j] = imagen[i][j]  #Pixel de la imagen con ruido con borde.
-            
-                    else: 
-                        parche = img_padding[i:i+3, j:j+3] #Parche 3x3.
-                        img_anisotropico[i][j] = np.mean(parche) #Media del parche.
-        
-            contador = contador + 1  
-        
-        else: #Coge la imagen filtrada y se repite el mismo proceso. 
-            img_sobel = skimage.filters.sobel(img_anisotropico)
-            img_padding = pad(img_anisotropico, (1,1), 'edge')
-       
-            for i in range(img_sobel.shape[0]): 
-                for j in range(img_sobel.shape[1]): 
-        
-                    if img_sobel[i][j] > umbral: 
-                        img_anisotropico[i][j] = img_anisotropico[i][j]
-            
-                    else:
-                        parche = img_padding[i:i+3, j:j+3] 
-                        img_anisotropico[i][j] = np.mean(parche) 
-    
-            contador = contador + 1 #Seguimos con la siguiente iteración. 
+    img_anisotropico = filtro_anisotropico(imagen, umbral, iteraciones, modo, tolerancia)
             
     return img_anisotropico
\ No newline at end of file
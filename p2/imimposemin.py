@@ -6,9 +6,120 @@ Reference: https://www.mathworks.com/help/images/ref/imimposemin.html
 
 import numpy as np
 import math
-from skimage.morphology import reconstruction, square, disk, cube
+from numba import njit
+from skimage.morphology import reconstruction, disk, ball
 
-def imimposemin(I, BW, conn=None, max_value=255):
+
+# neighbourhood offsets (dz, dy, dx) in raster order for each connectivity
+def neighbour_offsets(conn):
+    r = (-1, 0, 1)
+    if conn in (4, 8):
+        limit = 1 if conn == 4 else 2
+        offsets = [(0, a, b) for a in r for b in r if 0 < abs(a) + abs(b) <= limit]
+    else:
+        limit = {6: 1, 18: 2, 26: 3}[conn]
+        offsets = [(a, b, c) for a in r for b in r for c in r if 0 < abs(a) + abs(b) + abs(c) <= limit]
+
+    return np.array(offsets, dtype=np.int64)
+
+
+@njit(cache=True)
+def _grow(queue, head, size):
+    # ring buffer (power of two capacity) with twice the capacity and the same items from index 0
+    bigger = np.empty(2*queue.shape[0], dtype=queue.dtype)
+    for k in range(size):
+        bigger[k] = queue[(head + k) & (queue.shape[0] - 1)]
+    return bigger
+
+
+@njit(cache=True)
+def _collect(J, mask, offsets, queue, head, size, start, stop):
+    # queue the pixels in [start, stop) that can still lower a neighbour, until the queue is full
+    end = queue.shape[0] - 1
+    half = offsets.shape[0] // 2
+    p = start
+    while p < stop and size < queue.shape[0]:
+        v = J[p]
+        for k in range(half, offsets.shape[0]):
+            q = p + offsets[k]
+            if J[q] > v and J[q] > mask[q]:
+                queue[(head + size) & end] = p
+                size += 1
+                break
+        p += 1
+    return p, size
+
+
+@njit(cache=True)
+def _propagate(J, mask, offsets, queue, head, size):
+    # FIFO propagation until the queue is empty or has no room for the neighbours of one more pixel
+    end = queue.shape[0] - 1
+    while size > 0 and size + offsets.shape[0] <= queue.shape[0]:
+        p = queue[head]
+        head = (head + 1) & end
+        size -= 1
+        v = J[p]
+        for k in range(offsets.shape[0]):
+            q = p + offsets[k]
+            if J[q] > v and J[q] != mask[q]:
+                J[q] = v if v > mask[q] else mask[q]
+                queue[(head + size) & end] = q
+                size += 1
+    return head, size
+
+
+@njit(cache=True)
+def reconstruction_by_erosion(J, mask, offsets, shape):
+    '''
+    Grayscale reconstruction by erosion of the marker J above the mask, in place (Vincent's hybrid
+    algorithm: one raster pass, one anti-raster pass and a FIFO queue for the remaining propagation).
+    J and mask are flattened padded volumes of the given (padded) shape whose border holds the
+    largest value in both, so it never changes and needs no bounds checks. offsets are the flat
+    offsets of the neighbours in raster order.
+    '''
+    depth, rows, cols = shape
+    n_offsets = offsets.shape[0]
+    half = n_offsets // 2  # offsets[:half] come before the pixel in raster order
+    z0 = 1 if depth > 1 else 0  # a 2-D image has no padding along z
+
+    # raster pass
+    for z in range(z0, depth - z0):
+        for y in range(1, rows - 1):
+            base = (z*rows + y)*cols
+            for p in range(base + 1, base + cols - 1):
+                v = J[p]
+                for k in range(half):
+                    if J[p + offsets[k]] < v:
+                        v = J[p + offsets[k]]
+                J[p] = v if v > mask[p] else mask[p]
+
+    # anti-raster pass
+    for z in range(depth - 1 - z0, z0 - 1, -1):
+        for y in range(rows - 2, 0, -1):
+            base = (z*rows + y)*cols
+            for p in range(base + cols - 2, base, -1):
+                v = J[p]
+                for k in range(half, n_offsets):
+                    if J[p + offsets[k]] < v:
+                        v = J[p + offsets[k]]
+                J[p] = v if v > mask[p] else mask[p]
+
+    # queue the pixels that can still lower a neighbour (the condition of the anti-raster pass, which
+    # only depends on values that pass already fixed) and propagate; the border is never queued
+    capacity = 1024
+    while capacity < J.size // 16:
+        capacity *= 2
+    queue = np.empty(capacity, dtype=np.int64)
+    head, size = 0, 0
+    start, stop = (z0*rows + 1)*cols + 1, ((depth - z0 - 1)*rows + rows - 1)*cols - 1
+    while start < stop or size > 0:
+        start, size = _collect(J, mask, offsets, queue, head, size, start, stop)
+        head, size = _propagate(J, mask, offsets, queue, head, size)
+        if size + n_offsets > queue.shape[0]:
+            queue, head = _grow(queue, head, size), 0
+
+
+def imimposemin(I, BW, conn=None, max_value=255, method='numba'):
     if not I.ndim in (2, 3):
         raise Exception("'I' must be a 2-D or 3D array.")
 
@@ -29,12 +140,60 @@ def imimposemin(I, BW, conn=None, max_value=255):
             raise Exception("'conn' is invalid for a 3-D image.")
         elif conn in (6, 18, 26) and I.ndim == 2:
             raise Exception("'conn' is invalid for a 2-D image.")
+        elif conn not in (4, 8, 6, 18, 26):
+            raise Exception("'conn' must be 4, 8, 6, 18 or 26.")
+
+    if method == 'skimage':
+        return imimposemin_skimage(I, BW, conn)
+    elif method != 'numba':
+        raise Exception("'method' must be 'numba' or 'skimage'.")
+
+    # the result only takes values of I + h, so the reconstruction runs on I itself (float32, uint16...)
+    # with the extreme values of its type standing for -inf (markers) and inf, and h is added afterwards
+    if np.issubdtype(I.dtype, np.floating):
+        work = I.dtype
+        low, high = -np.inf, np.inf
+        out_dtype = I.dtype
+        I_range = np.amax(I) - np.amin(I)
+        h = 0.1 if I_range == 0 else I_range*0.001
+    elif np.issubdtype(I.dtype, np.integer) or I.dtype == bool:
+        work = np.uint8 if I.dtype == bool else I.dtype
+        low, high = np.iinfo(work).min, np.iinfo(work).max
+        out_dtype = np.float32 if np.iinfo(work).bits <= 16 else np.float64  # exact in float32
+        h = 1
+    else:
+        raise Exception("'I' must be a numeric array.")
+
+    if not BW.any():
+        return np.full(I.shape, np.inf, dtype=out_dtype)
+
+    # padded mask (I, low on the markers, high on the border) and marker (low on the markers, high elsewhere)
+    pad = ((1, 1),)*I.ndim
+    mask = np.pad(I.astype(work, copy=False), pad, constant_values=high)
+    interior = (slice(1, -1),)*I.ndim
+    mask[interior][BW] = low
+    J = np.full(mask.shape, high, dtype=work)
+    J[interior][BW] = low
+
+    shape = mask.shape if I.ndim == 3 else (1,) + mask.shape
+    offsets = neighbour_offsets(conn)
+    flat_offsets = (offsets[:, 0]*shape[1] + offsets[:, 1])*shape[2] + offsets[:, 2]
+    reconstruction_by_erosion(J.reshape(-1), mask.reshape(-1), flat_offsets, shape)
+
+    J = J[interior].astype(out_dtype)
+    J += h
+    J[BW] = -np.inf
+
+    return J
+
 
+# original implementation on skimage.morphology.reconstruction (float64)
+def imimposemin_skimage(I, BW, conn):
     # create structuring element depending on connectivity
     if conn == 4:
         selem = disk(1)
     elif conn == 8:
-        selem = square(3)
+        selem = np.ones((3, 3), dtype=np.uint8)  # square(3), deprecated in skimage
     elif conn == 6:
         selem = ball(1)
     elif conn == 18:
@@ -43,7 +202,7 @@ def imimposemin(I, BW, conn=None, max_value=255):
         selem[:, :, 1] = 1
         selem[1] = 1
     elif conn == 26:
-        selem = cube(3)
+        selem = np.ones((3, 3, 3), dtype=np.uint8)  # cube(3), deprecated in skimage
 
     fm = I.astype(float)
 
@@ -70,10 +229,10 @@ def imimposemin(I, BW, conn=None, max_value=255):
 
     # perform reconstruction and get the image complement of the result
     if I.dtype == float:
-        J = reconstruction(1 - fm, 1 - g, selem=selem)
+        J = reconstruction(1 - fm, 1 - g, footprint=selem)
         J = 1 - J
     else:
-        J = reconstruction(255 - fm, 255 - g, method='dilation', selem=selem)
+        J = reconstruction(255 - fm, 255 - g, method='dilation', footprint=selem)
         J = 255 - J
 
     try:
@@ -81,4 +240,4 @@ def imimposemin(I, BW, conn=None, max_value=255):
     except:
         J[BW] = -float("inf")
 
-    return J
\ No newline at end of file
+    return J
@@ -4,6 +4,9 @@ from matplotlib import pyplot as plt
 import pydicom
 import numpy as np
 import math
+from scipy import ndimage
+from skimage.filters import threshold_otsu
+from skimage.feature import peak_local_max
 from funciones_p2 import *
 from RegionGrowing import *
 
@@ -46,6 +49,89 @@ def semillas(imagen, n):
     return semillas_list 
 
 
+#DISTANCIA AL FONDO
+def distancia_al_fondo(mascara):
+    '''
+    Distancia de cada píxel de la máscara al fondo más cercano. Fuera de la imagen también se considera
+    fondo, así que los píxeles del borde de la imagen valen como mucho 1.
+    '''
+    
+    distancia = ndimage.distance_transform_edt(np.pad(mascara, 1)) #Borde de un píxel de fondo.
+    
+    return distancia[(slice(1, -1),)*mascara.ndim]
+
+
+#SEMILLAS AUTOMÁTICAS
+def semillas_auto(imagen, n, metodo='distancia', archivo=None, distancia_min=10, bins=256):
+    '''
+    Semillas de la imagen sin interacción (para procesar lotes de imágenes).
+    
+    Parámetros:
+        imagen : matriz de la imagen.
+        n : número (máximo) de semillas.
+        metodo : 'distancia' (máximos de la transformada de distancia de la máscara de Otsu),
+                 'histograma' (un píxel por cada pico del histograma) o 'archivo' (semillas guardadas).
+        archivo : en modo 'archivo', archivo de texto con una semilla (fila columna) por línea, como el
+                  que escribe guardar_semillas.
+        distancia_min : distancia mínima en píxeles entre dos semillas (modo 'distancia').
+        bins : número de intervalos del histograma (modo 'histograma').
+        
+    Devuelve:
+        semillas_list : lista de tuplas (fila, columna), el mismo formato que semillas.
+    
+    Notas:
+        En modo 'distancia' se umbraliza la imagen con Otsu y las semillas son los máximos locales de
+        la distancia de cada píxel de la máscara al fondo (fuera de la imagen también es fondo), es decir,
+        los centros de las zonas claras, de la más ancha a la más estrecha.
+        En modo 'histograma' se buscan los n picos más altos del histograma (suavizado), incluidos los de
+        los extremos, y para cada uno se toma la máscara de los píxeles de los intervalos que forman el
+        pico (el propio y sus dos vecinos). La semilla es el píxel de la máscara más alejado de su borde,
+        así que queda en el interior de una zona de ese nivel de gris.
+    '''
+    
+    if metodo == 'archivo':
+        coords = np.loadtxt(archivo, dtype=np.int64, ndmin=2)[:n]
+    
+    elif metodo == 'distancia':
+        mascara = imagen > threshold_otsu(imagen) #Zonas claras.
+        distancia = distancia_al_fondo(mascara) #Distancia de cada píxel al fondo.
+        coords = peak_local_max(distancia, min_distance=distancia_min, num_peaks=n, exclude_border=False)
+    
+    elif metodo == 'histograma':
+        hist, bordes = np.histogram(imagen, bins=bins)
+        suavizado = np.convolve(hist, np.ones(3)/3, mode='same') #Histograma suavizado.
+        relleno = np.pad(suavizado, 1, constant_values=-1) #Los extremos también pueden ser picos.
+        picos = np.flatnonzero((relleno[1:-1] > relleno[:-2]) & (relleno[1:-1] >= relleno[2:])) #Máximos locales.
+        picos = picos[suavizado[picos] > 0]
+        picos = picos[np.argsort(suavizado[picos], kind='stable')[::-1][:n]] #Los n picos más altos.
+        intervalo = np.clip(np.digitize(imagen, bordes) - 1, 0, bins - 1) #Intervalo de cada píxel.
+        
+        coords = []
+        for pico in picos:
+            mascara = np.abs(intervalo - pico) <= 1 #Píxeles de los intervalos que forman el pico.
+            if not mascara.any():
+                continue
+            distancia = distancia_al_fondo(mascara)
+            coords.append(np.unravel_index(np.argmax(distancia), imagen.shape)) #Píxel más interior.
+    
+    else:
+        raise ValueError("'metodo' debe ser 'distancia', 'histograma' o 'archivo'.")
+    
+    semillas_list = [(int(fila), int(col)) for fila, col in coords]
+    
+    return semillas_list
+
+
+#GUARDADO DE SEMILLAS
+def guardar_semillas(archivo, semillas_list):
+    '''
+    Guarda las semillas (lista de (fila, columna)) en un archivo de texto, una por línea, para leerlas
+    después con semillas_auto(imagen, n, 'archivo', archivo).
+    '''
+    
+    np.savetxt(archivo, np.asarray(semillas_list, dtype=np.int64).reshape(-1, 2), fmt='%d')
+
+
 #------------------------------------EXTRACCIÓN DE SEMILLAS-----------------------------------------
 # img_norm1 = normalizar('imagen1.dcm') #Se normaliza la imagen.
 # list_sem1 = semillas(img_norm1, 8)
@@ -54,4 +140,6 @@ def semillas(imagen, n):
 #list_sem2 = semillas(img_norm2, 1)
 
 #img_norm3 = normalizar('imagen4.dcm') #Se normaliza la imagen.
-#list_sem3 = semillas(img_norm3, 15)
\ No newline at end of file
+#list_sem3 = semillas(img_norm3, 15)
+
+#list_sem3 = semillas_auto(img_norm3, 15) #Sin interacción.
\ No newline at end of file
@@ -1,5 +1,7 @@
 from __main__ import vtk, qt, ctk, slicer
 import numpy as np 
+from CorrelationLib import pearson_correlation
+from JobRunnerLib import JobRunner
 
 #
 # Correlation
@@ -89,12 +91,28 @@ class CorrelationWidget:
     #bind button to frame
     self.formFrame.layout().addWidget(button)
 
+    #Boton que cancela el calculo en curso
+    cancelButton = qt.QPushButton("Cancel")
+    cancelButton.toolTip = "Cancela el calculo de la correlacion"
+    cancelButton.connect("clicked(bool)", self.cancelButtonClicked)
+    self.formFrame.layout().addWidget(cancelButton)
+
     #Rectangulo donde va a aparecer la correlacion
     self.textfield = qt.QTextEdit()
     self.textfield.setReadOnly(True)
     #bind textfield to frame
     self.formFrame.layout().addWidget(self.textfield)
 
+    #Calculo en segundo plano: el temporizador entrega el progreso y el resultado en el hilo de la interfaz
+    self.jobs = JobRunner()
+    self.timer = qt.QTimer()
+    self.timer.setInterval(50)
+    self.timer.connect("timeout()", self.pollJobs)
+
+  def cleanup(self):
+    self.timer.stop()
+    self.jobs.shutdown(wait=False)
+
   def informationButtonClicked(self): 
     inputVolume1 = self.inputSelector1.currentNode()
     inputVolume2 = self.inputSelector2.currentNode()
@@ -103,28 +121,27 @@ class CorrelationWidget:
     matriz1 = slicer.util.arrayFromVolume(inputVolume1)
     matriz2 = slicer.util.arrayFromVolume(inputVolume2)
 
-    #Dimensiones de las matrices
-    matriz1_dim = matriz1.shape
-    matriz2_dim = matriz2.shape
-
-    min_x = min(matriz1_dim[0], matriz2_dim[0])
-    min_y = min(matriz1_dim[1], matriz2_dim[1])
-    min_z = min(matriz1_dim[2], matriz2_dim[2])
+    #Correlacion en segundo plano (recorte a la dimension comun y una sola pasada por bloques).
+    #Si se pulsa otra vez antes de terminar, solo se calcula la ultima peticion
+    self.textfield.setText("Calculando...")
+    self.jobs.submit(pearson_correlation, matriz1, matriz2, onDone=self.showCorrelation,
+                     onProgress=self.showProgress, onError=self.showError)
+    self.timer.start()
 
-    #Resize de las matrices para que sean iguales
-    matriz1_redim = np.resize(matriz1, (min_x, min_y, min_z))
-    matriz2_redim = np.resize(matriz2, (min_x, min_y, min_z))
+  def cancelButtonClicked(self):
+    self.jobs.cancel()
+    self.textfield.setText("Cancelado")
 
-    #Correlacion
-    n = min_x*min_y*min_z
+  def pollJobs(self):
+    if not self.jobs.poll():
+      self.timer.stop()
 
-    des_m1 = np.std(matriz1_redim)
-    des_m2 = np.std(matriz2_redim)
+  def showProgress(self, fraccion):
+    self.textfield.setText("Calculando... %d%%" % (100*fraccion))
 
-    media_m1 = np.mean(matriz1_redim)
-    media_m2 = np.mean(matriz2_redim)
-
-    cor = (np.sum((1/(des_m1*des_m2))*(matriz1_redim-media_m1)*(matriz2_redim-media_m2)))/n
-
-    self.textfield.setText(cor)
+  def showCorrelation(self, cor):
+    self.textfield.setText(str(cor))
     #self.textfield.insertPlainText(cor)
+
+  def showError(self, error):
+    self.textfield.setText("Error: %s" % error)
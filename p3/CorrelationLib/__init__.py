@@ -0,0 +1 @@
+from .correlation import *
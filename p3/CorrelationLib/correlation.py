@@ -0,0 +1,234 @@
+"""
+Logica del modulo Correlation, solo con NumPy (se puede usar y probar fuera de Slicer).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+__all__ = ['crop_common', 'pearson_correlation', 'local_correlation', 'correlation_matrix']
+
+#
+# Recorte
+#
+
+def crop_common(*volumes):
+  """Vistas (sin copia) de los volumenes recortados a la dimension comun (minimo de cada eje)."""
+  shape = tuple(min(dims) for dims in zip(*(volume.shape for volume in volumes)))
+  region = tuple(slice(0, size) for size in shape)
+  return tuple(volume[region] for volume in volumes)
+
+
+def iter_chunks(shape, chunk_voxels):
+  """Bloques (cortes y filas) de como mucho chunk_voxels voxeles que recorren un volumen 3D."""
+  nz, ny, nx = shape
+  bz = max(1, chunk_voxels // max(1, ny*nx))
+  by = ny if bz > 1 else max(1, min(ny, chunk_voxels // max(1, nx)))
+  for z0 in range(0, nz, bz):
+    for y0 in range(0, ny, by):
+      yield (slice(z0, z0 + bz), slice(y0, y0 + by))
+
+#
+# Correlacion de Pearson
+#
+
+def pearson_correlation(volume1, volume2, chunk_voxels=1 << 20, progress=None):
+  """Coeficiente de correlacion de Pearson entre dos volumenes.
+
+  Los volumenes se recortan a su dimension comun con vistas y se recorren una sola vez por bloques
+  de chunk_voxels voxeles. De cada bloque se calculan (en float64) la media, la suma de cuadrados
+  centrada y el co-momento, y se acumulan con las formulas de Welford/Chan, asi que la memoria
+  extra solo depende del tamano del bloque y no hay perdida de precision por restar sumas grandes.
+  Devuelve nan si alguno de los volumenes es constante. Si se da progress, se llama con la fraccion
+  calculada despues de cada bloque (puede lanzar una excepcion para cancelar).
+  """
+  volume1, volume2 = crop_common(np.asarray(volume1), np.asarray(volume2))
+  if volume1.ndim != 3:
+    raise ValueError("Los volumenes deben ser 3D.")
+
+  n = 0
+  mean1 = mean2 = 0.0
+  m2_1 = m2_2 = comoment = 0.0
+  regions = list(iter_chunks(volume1.shape, chunk_voxels))
+  for index, region in enumerate(regions):
+    block1 = volume1[region].astype(np.float64).ravel()
+    block2 = volume2[region].astype(np.float64).ravel()
+    nb = block1.size
+    if nb == 0:
+      continue
+
+    #Estadisticos del bloque
+    mean_b1 = block1.mean()
+    mean_b2 = block2.mean()
+    block1 -= mean_b1
+    block2 -= mean_b2
+    m2_b1 = np.dot(block1, block1)
+    m2_b2 = np.dot(block2, block2)
+    comoment_b = np.dot(block1, block2)
+
+    #Union con lo acumulado
+    total = n + nb
+    delta1 = mean_b1 - mean1
+    delta2 = mean_b2 - mean2
+    mean1 += delta1*nb/total
+    mean2 += delta2*nb/total
+    m2_1 += m2_b1 + delta1*delta1*n*nb/total
+    m2_2 += m2_b2 + delta2*delta2*n*nb/total
+    comoment += comoment_b + delta1*delta2*n*nb/total
+    n = total
+    if progress is not None:
+      progress((index + 1) / len(regions))
+
+  denominator = np.sqrt(m2_1*m2_2)
+  if n == 0 or denominator == 0:
+    return float('nan')
+  return float(comoment/denominator)
+
+#
+# Correlacion local (NCC por ventanas)
+#
+
+def summed_area_table(block, out):
+  """Tabla de sumas acumuladas 3D de block en out, que tiene un plano de ceros delante en cada eje."""
+  out[0] = 0
+  out[:, 0] = 0
+  out[:, :, 0] = 0
+  inner = out[1:, 1:, 1:]
+  np.cumsum(block, axis=0, out=inner)
+  np.cumsum(inner, axis=1, out=inner)
+  np.cumsum(inner, axis=2, out=inner)
+  return out
+
+
+def window_sum(table, bounds, out):
+  """Suma de cada ventana a partir de la tabla (8 esquinas). bounds son los (lo, hi) de cada eje."""
+  (lz, hz), (ly, hy), (lx, hx) = bounds
+  out[...] = 0
+  for z, sign_z in ((hz, 1), (lz, -1)):
+    for y, sign_y in ((hy, 1), (ly, -1)):
+      for x, sign_x in ((hx, 1), (lx, -1)):
+        if sign_z*sign_y*sign_x > 0:
+          out += table[np.ix_(z, y, x)]
+        else:
+          out -= table[np.ix_(z, y, x)]
+  return out
+
+
+def local_correlation(volume1, volume2, radius=3, chunk_slices=16, progress=None):
+  """Mapa de correlacion cruzada normalizada (NCC) local entre dos volumenes.
+
+  En cada voxel se calcula la correlacion de Pearson de los dos volumenes dentro de una ventana de
+  (2*radius+1) voxeles por eje centrada en el (recortada en los bordes). radius puede ser un numero o
+  uno por eje (z, y, x). Las medias, varianzas y covarianza de todas las ventanas salen de tablas de
+  sumas acumuladas 3D, asi que el coste es O(N) sea cual sea la ventana. El volumen se procesa por
+  bloques de chunk_slices cortes (con radius cortes de margen a cada lado), asi que la memoria solo
+  depende del tamano del bloque. Los valores se centran con la media global para no perder
+  precision en las sumas. Donde alguno de los volumenes es constante en la ventana el mapa vale 0.
+  Devuelve un mapa float32 de la dimension comun de los volumenes. progress, como en
+  pearson_correlation, se llama despues de cada bloque.
+  """
+  volume1, volume2 = crop_common(np.asarray(volume1), np.asarray(volume2))
+  if volume1.ndim != 3:
+    raise ValueError("Los volumenes deben ser 3D.")
+  radius = np.broadcast_to(np.asarray(radius, dtype=np.int64), (3,))
+  nz, ny, nx = volume1.shape
+  mean1 = volume1.mean(dtype=np.float64)
+  mean2 = volume2.mean(dtype=np.float64)
+
+  def bounds(start, stop, n, r, offset):
+    i = np.arange(start, stop)
+    return np.maximum(i - r, 0) - offset, np.minimum(i + r + 1, n) - offset
+
+  yx_bounds = [bounds(0, ny, ny, radius[1], 0), bounds(0, nx, nx, radius[2], 0)]
+  ncc = np.empty(volume1.shape, dtype=np.float32)
+  for z0 in range(0, nz, chunk_slices):
+    z1 = min(z0 + chunk_slices, nz)
+    zin0, zin1 = max(z0 - radius[0], 0), min(z1 + radius[0], nz) #Bloque con margen
+    chunk_bounds = [bounds(z0, z1, nz, radius[0], zin0)] + yx_bounds
+
+    a = volume1[zin0:zin1].astype(np.float64)
+    a -= mean1
+    b = volume2[zin0:zin1].astype(np.float64)
+    b -= mean2
+    table = np.empty((zin1 - zin0 + 1, ny + 1, nx + 1))
+    shape = (z1 - z0, ny, nx)
+
+    #Numero de voxeles de cada ventana
+    count = np.multiply.outer(np.multiply.outer(*[hi - lo for lo, hi in chunk_bounds[:2]]),
+                              chunk_bounds[2][1] - chunk_bounds[2][0]).astype(np.float64)
+
+    #Medias, varianzas y covarianza de cada ventana
+    def window_mean(block):
+      return window_sum(summed_area_table(block, table), chunk_bounds, np.empty(shape)) / count
+
+    mean_a = window_mean(a)
+    mean_b = window_mean(b)
+    cov = window_mean(a*b) - mean_a*mean_b
+    square_a = window_mean(np.square(a, out=a))
+    square_b = window_mean(np.square(b, out=b))
+    var_a = square_a - mean_a*mean_a
+    var_b = square_b - mean_b*mean_b
+
+    #Ventanas constantes (varianza del orden del error de redondeo)
+    valid = (var_a > 1e-10*square_a) & (var_b > 1e-10*square_b)
+    var = np.multiply(var_a, var_b, out=var_a)
+    np.divide(cov, np.sqrt(var, where=valid, out=var), where=valid, out=cov)
+    cov[~valid] = 0
+    ncc[z0:z1] = np.clip(cov, -1, 1)
+    if progress is not None:
+      progress(z1 / nz)
+
+  return ncc
+
+#
+# Matriz de correlacion entre K volumenes
+#
+
+def correlation_matrix(volumes, chunk_voxels=1 << 18, workers=None, progress=None):
+  """Matriz K x K de correlaciones de Pearson entre K volumenes.
+
+  Los volumenes se recortan (con vistas) a su dimension comun. Primero se calcula la media de cada
+  volumen y despues, por bloques de chunk_voxels voxeles, la matriz de Gram de los K bloques
+  centrados (un producto K x chunk por chunk x K), que se acumula en float64. De la diagonal salen
+  las normas y del resto los co-momentos. Los bloques se reparten en un conjunto de workers hilos
+  (NumPy libera el GIL en los productos); cada bloque devuelve su matriz de Gram parcial K x K y
+  este hilo las va sumando en una sola matriz, asi que la memoria crece con K y el tamano del
+  bloque, no con el tamano de los volumenes. Las filas y columnas de los volumenes constantes son
+  nan. progress, como en pearson_correlation, se llama (desde este hilo) despues de acumular cada
+  bloque.
+  """
+  volumes = crop_common(*[np.asarray(volume) for volume in volumes])
+  if volumes[0].ndim != 3:
+    raise ValueError("Los volumenes deben ser 3D.")
+  k = len(volumes)
+  regions = list(iter_chunks(volumes[0].shape, chunk_voxels))
+
+  executor = ThreadPoolExecutor(max_workers=workers)
+  try:
+    #Media de cada volumen (una pasada por volumen)
+    def volume_mean(volume):
+      return sum(volume[region].sum(dtype=np.float64) for region in regions) / volume.size
+    means = np.array(list(executor.map(volume_mean, volumes)))
+
+    #Matriz de Gram de los bloques centrados
+    def block_gram(region):
+      block = np.empty((k, volumes[0][region].size))
+      for i, volume in enumerate(volumes):
+        block[i] = volume[region].ravel()
+      block -= means[:, None]
+      return block @ block.T
+
+    gram = np.zeros((k, k))
+    for index, partial in enumerate(executor.map(block_gram, regions)):
+      gram += partial
+      if progress is not None:
+        progress((index + 1) / len(regions))
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True) #Si se cancela, no se calculan los bloques que faltan
+
+  norms = np.sqrt(np.diag(gram))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    matrix = gram / np.outer(norms, norms)
+  matrix[norms == 0] = np.nan
+  matrix[:, norms == 0] = np.nan
+
+  return matrix
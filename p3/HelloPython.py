@@ -3,6 +3,9 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import numpy as np
+from HelloPythonLib import threshold_array
+from JobRunnerLib import JobRunner
 
 #
 # HelloPython
@@ -94,6 +97,14 @@ class HelloPythonWidget(ScriptedLoadableModuleWidget):
     self.imageThresholdSliderWidget.setToolTip("Set threshold value for computing the output image. Voxels that have intensities lower than this value will set to zero.")
     parametersFormLayout.addRow("Image threshold", self.imageThresholdSliderWidget)
 
+    #
+    # check box to recompute the output whenever the threshold changes
+    #
+    self.autoApplyCheckBox = qt.QCheckBox()
+    self.autoApplyCheckBox.checked = 0
+    self.autoApplyCheckBox.setToolTip("If checked, the output is recomputed in the background whenever the threshold changes.")
+    parametersFormLayout.addRow("Auto apply", self.autoApplyCheckBox)
+
     #
     # check box to trigger taking screen shots for later use in tutorials
     #
@@ -114,6 +125,13 @@ class HelloPythonWidget(ScriptedLoadableModuleWidget):
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.imageThresholdSliderWidget.connect("valueChanged(double)", self.onThresholdChanged)
+
+    # background jobs: the timer delivers the results on the GUI thread
+    self.jobs = JobRunner()
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(50)
+    self.pollTimer.connect("timeout()", self.onPollTimer)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -122,7 +140,8 @@ class HelloPythonWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.pollTimer.stop()
+    self.jobs.shutdown(wait=False)
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector.currentNode() and self.outputSelector.currentNode()
@@ -131,7 +150,17 @@ class HelloPythonWidget(ScriptedLoadableModuleWidget):
     logic = HelloPythonLogic()
     enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
     imageThreshold = self.imageThresholdSliderWidget.value
-    logic.run(self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold, enableScreenshotsFlag)
+    # runs in the background; repeated clicks or slider moves only compute the latest request
+    if logic.runInBackground(self.jobs, self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold, enableScreenshotsFlag):
+      self.pollTimer.start()
+
+  def onThresholdChanged(self, value):
+    if self.autoApplyCheckBox.checked and self.applyButton.enabled:
+      self.onApplyButton()
+
+  def onPollTimer(self):
+    if not self.jobs.poll():
+      self.pollTimer.stop()
 
 #
 # HelloPythonLogic
@@ -174,7 +203,102 @@ class HelloPythonLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def run(self, inputVolume, outputVolume, imageThreshold, enableScreenshots=0):
+  def matchingOutputArray(self, inputArray, outputVolume):
+    """Voxel array of the output volume if it has the shape and type of the input, otherwise None.
+    """
+    if not self.hasImageData(outputVolume):
+      return None
+    outputArray = slicer.util.arrayFromVolume(outputVolume)
+    if outputArray.shape != inputArray.shape or outputArray.dtype != inputArray.dtype:
+      return None
+    return outputArray
+
+  def setOutput(self, inputVolume, outputVolume, resultArray=None):
+    """Notify the output volume of new voxels (or set them from resultArray) and copy the input
+    geometry, as the CLI does.
+    """
+    if resultArray is None:
+      slicer.util.arrayFromVolumeModified(outputVolume)
+    else:
+      outputArray = self.matchingOutputArray(resultArray, outputVolume)
+      if outputArray is None:
+        slicer.util.updateVolumeFromArray(outputVolume, resultArray)
+      else:
+        outputArray[...] = resultArray
+        slicer.util.arrayFromVolumeModified(outputVolume)
+
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    outputVolume.SetIJKToRASMatrix(ijkToRas)
+
+  def thresholdInProcess(self, inputVolume, outputVolume, imageThreshold):
+    """Threshold with HelloPythonLib on the arrayFromVolume views (no CLI process).
+    If the output volume already has image data of the same shape and type, the result is written
+    straight into its voxel array; otherwise the output image data is created from the result.
+    """
+    inputArray = slicer.util.arrayFromVolume(inputVolume)
+    outputArray = self.matchingOutputArray(inputArray, outputVolume)
+    if outputArray is not None:
+      threshold_array(inputArray, imageThreshold, 'Above', out=outputArray)
+      self.setOutput(inputVolume, outputVolume)
+    else:
+      self.setOutput(inputVolume, outputVolume, threshold_array(inputArray, imageThreshold, 'Above'))
+
+  def thresholdWithCli(self, inputVolume, outputVolume, imageThreshold):
+    """Threshold with the Threshold Scalar Volume CLI module (waits for it to finish).
+    """
+    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': outputVolume.GetID(), 'ThresholdValue' : imageThreshold, 'ThresholdType' : 'Above'}
+    return slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+
+  def runInBackground(self, runner, inputVolume, outputVolume, imageThreshold, enableScreenshots=0):
+    """
+    Run the algorithm with a JobRunner: the threshold is computed in the worker thread into a new
+    array, slice by slice so that a cancelled or superseded job stops after the current slice, and
+    copied into the output volume on the GUI thread (when runner.poll() delivers it). If the
+    in-process threshold fails, the Threshold Scalar Volume CLI module is used instead, as in run().
+    """
+
+    if not self.isValidInputOutputData(inputVolume, outputVolume):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return False
+
+    logging.info('Processing started')
+    inputArray = slicer.util.arrayFromVolume(inputVolume)
+
+    def compute(progress):
+      resultArray = np.empty_like(inputArray)
+      for k in range(len(inputArray)):
+        threshold_array(inputArray[k], imageThreshold, 'Above', out=resultArray[k])
+        progress((k + 1) / len(inputArray))
+      return resultArray
+
+    def completed():
+      if enableScreenshots:
+        self.takeScreenshot('HelloPythonTest-Start','MyScreenshot',-1)
+      logging.info('Processing completed')
+
+    def fail(error):
+      # same fallback as run(): the CLI module, on the GUI thread
+      logging.warning('In-process threshold failed (%s), using the CLI module' % error)
+      try:
+        self.thresholdWithCli(inputVolume, outputVolume, imageThreshold)
+      except Exception as e:
+        slicer.util.errorDisplay('Threshold failed: %s' % e)
+        return
+      completed()
+
+    def finish(resultArray):
+      try:
+        self.setOutput(inputVolume, outputVolume, resultArray)
+      except Exception as e:
+        fail(e)
+        return
+      completed()
+
+    runner.submit(compute, onDone=finish, onError=fail)
+    return True
+
+  def run(self, inputVolume, outputVolume, imageThreshold, enableScreenshots=0, useCli=False):
     """
     Run the actual algorithm
     """
@@ -185,9 +309,16 @@ class HelloPythonLogic(ScriptedLoadableModuleLogic):
 
     logging.info('Processing started')
 
-    # Compute the thresholded output volume using the Threshold Scalar Volume CLI module
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': outputVolume.GetID(), 'ThresholdValue' : imageThreshold, 'ThresholdType' : 'Above'}
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    # Compute the thresholded output volume in process, or with the Threshold Scalar Volume CLI module
+    # if requested or if the in-process path fails
+    if not useCli:
+      try:
+        self.thresholdInProcess(inputVolume, outputVolume, imageThreshold)
+      except Exception as e:
+        logging.warning('In-process threshold failed (%s), using the CLI module' % e)
+        useCli = True
+    if useCli:
+      cliNode = self.thresholdWithCli(inputVolume, outputVolume, imageThreshold)
 
     # Capture screenshot
     if enableScreenshots:
@@ -215,6 +346,8 @@ class HelloPythonTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_HelloPython1()
+    self.test_HelloPython2()
+    self.test_HelloPython3()
 
   def test_HelloPython1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -243,3 +376,36 @@ class HelloPythonTest(ScriptedLoadableModuleTest):
     logic = HelloPythonLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_HelloPython2(self):
+    """ Test the in-process threshold core (same semantics as the CLI module) without any data.
+    """
+
+    self.delayDisplay("Starting the threshold core test")
+    volume = np.array([[[-5, 0, 3], [7, 10, 2]]], dtype=np.int16)
+    result = threshold_array(volume, 3, 'Above')
+    self.assertEqual(result.dtype, volume.dtype)
+    self.assertEqual(result.tolist(), [[[-5, 0, 3], [0, 0, 2]]])
+    self.assertEqual(threshold_array(volume, 0, 'Below', outsideValue=-1).tolist(), [[[-1, 0, 3], [7, 10, 2]]])
+    self.assertEqual(threshold_array(volume, 0, 'Outside', lower=0, upper=7).tolist(), [[[0, 0, 3], [7, 0, 2]]])
+    threshold_array(volume, 3, 'Above', out=volume)
+    self.assertEqual(volume.tolist(), [[[-5, 0, 3], [0, 0, 2]]])
+    self.delayDisplay('Test passed!')
+
+  def test_HelloPython3(self):
+    """ Test the background runner with a fake event loop: only the latest request is delivered.
+    """
+
+    import time
+    self.delayDisplay("Starting the background runner test")
+    volume = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    runner = JobRunner()
+    results = []
+    for threshold in (5, 10, 15):
+      runner.submit(lambda t, progress: threshold_array(volume, t, 'Above'), threshold, onDone=results.append)
+    while runner.poll():  # fake event loop
+      time.sleep(0.01)
+    runner.shutdown()
+    self.assertEqual(len(results), 1)
+    self.assertEqual(results[0].max(), 15)
+    self.delayDisplay('Test passed!')
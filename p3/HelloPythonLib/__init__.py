@@ -0,0 +1 @@
+from .threshold import *
@@ -0,0 +1,72 @@
+"""
+Thresholding core of the HelloPython module, NumPy only (usable and testable outside Slicer).
+"""
+
+import numpy as np
+
+try:
+  from numba import njit, prange
+except ImportError:
+  njit = None
+
+__all__ = ['threshold_mask', 'threshold_array']
+
+THRESHOLD_TYPES = ('Above', 'Below', 'Outside')
+
+
+def threshold_mask(array, thresholdType='Above', thresholdValue=0, lower=0, upper=0):
+  """Boolean mask of the voxels that the Threshold Scalar Volume CLI replaces with the outside value:
+  'Above' (voxels > thresholdValue), 'Below' (voxels < thresholdValue) or 'Outside' (voxels outside
+  [lower, upper]).
+  """
+  if thresholdType == 'Above':
+    return array > thresholdValue
+  if thresholdType == 'Below':
+    return array < thresholdValue
+  if thresholdType == 'Outside':
+    return (array < lower) | (array > upper)
+  raise ValueError("thresholdType must be one of %s" % (THRESHOLD_TYPES,))
+
+
+if njit is not None:
+  @njit(parallel=True, cache=True)
+  def _threshold_kernel(source, target, mode, low, high, outsideValue):
+    # one fused pass: copy and replace (mode 0 Above, 1 Below, 2 Outside)
+    for i in prange(source.size):
+      value = source[i]
+      if (mode == 0 and value > high) or (mode == 1 and value < low) or (mode == 2 and (value < low or value > high)):
+        target[i] = outsideValue
+      else:
+        target[i] = value
+
+
+def threshold_array(array, thresholdValue, thresholdType='Above', outsideValue=0, lower=0, upper=0, out=None):
+  """Threshold a volume array with the semantics of the Threshold Scalar Volume CLI.
+
+  The selected voxels (see threshold_mask) are set to outsideValue and the rest are copied. The
+  result is written to out if given (it may be the input itself, e.g. the arrayFromVolume view of
+  the output node) and otherwise to a new array of the input dtype. With numba installed the copy
+  and the replacement are a single parallel pass over C-contiguous arrays; otherwise two vectorized
+  NumPy passes are used.
+  """
+  if thresholdType not in THRESHOLD_TYPES:
+    raise ValueError("thresholdType must be one of %s" % (THRESHOLD_TYPES,))
+  if out is None:
+    out = np.empty_like(array)
+  elif out.shape != array.shape:
+    raise ValueError("out must have the same shape as the input array")
+
+  if (njit is not None and array.flags.c_contiguous and out.flags.c_contiguous
+      and array.dtype == out.dtype and not np.iscomplexobj(array)):
+    mode = THRESHOLD_TYPES.index(thresholdType)
+    low = lower if thresholdType == 'Outside' else thresholdValue
+    high = upper if thresholdType == 'Outside' else thresholdValue
+    _threshold_kernel(array.reshape(-1), out.reshape(-1), mode, float(low), float(high),
+                      out.dtype.type(outsideValue))
+    return out
+
+  mask = threshold_mask(array, thresholdType, thresholdValue, lower, upper)
+  if out is not array:
+    np.copyto(out, array)
+  out[mask] = outsideValue
+  return out
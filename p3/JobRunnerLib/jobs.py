@@ -0,0 +1,158 @@
+"""
+Background execution for the scripted modules, without Qt (usable and testable outside Slicer).
+
+The computation runs in a worker thread and the results are handed back on the GUI thread by
+poll(), which the widget calls from a qt.QTimer (a test can call it from a fake event loop):
+
+  runner = JobRunner()
+  runner.submit(pearson_correlation, array1, array2, onDone=showResult, onProgress=showProgress)
+  ...
+  runner.poll()  # on every timer tick, until it returns False
+"""
+
+import collections
+import logging
+import threading
+
+__all__ = ['JobCancelled', 'JobRunner']
+
+
+class JobCancelled(Exception):
+  """Raised by the progress callback of a job that was cancelled or superseded."""
+
+
+class Job(object):
+  def __init__(self, jobId, function, args, kwargs, onDone, onError, onProgress):
+    self.id = jobId
+    self.function = function
+    self.args = args
+    self.kwargs = kwargs
+    self.onDone = onDone
+    self.onError = onError
+    self.onProgress = onProgress
+    self.cancelled = False
+    self.progress = None  # latest progress not yet delivered
+
+
+class JobRunner(object):
+  """Runs one job at a time in a worker thread, keeping only the latest request.
+
+  submit() never blocks: if a job is running it is asked to stop and the new request waits; if a
+  request was already waiting it is dropped, and so are results not yet delivered, so repeated
+  clicks or slider changes only compute (and deliver) the last one. The job function receives a
+  progress(fraction) keyword argument; calling it reports progress and raises JobCancelled once
+  the job is cancelled or superseded, which is how a long NumPy loop stops early. Callbacks
+  (onDone(result), onError(exception), onProgress(fraction)) are only called from poll(), on the
+  caller's thread, and never for cancelled jobs.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._wake = threading.Condition(self._lock)
+    self._pending = None
+    self._running = None
+    self._events = collections.deque()
+    self._lastId = 0
+    self._closed = False
+    self._thread = None
+
+  def submit(self, function, *args, **kwargs):
+    """Request function(*args, progress=..., **kwargs) in the background and return the job id.
+    The keyword arguments onDone, onError and onProgress are taken as callbacks.
+    """
+    onDone = kwargs.pop('onDone', None)
+    onError = kwargs.pop('onError', None)
+    onProgress = kwargs.pop('onProgress', None)
+    with self._lock:
+      if self._closed:
+        raise RuntimeError('JobRunner is shut down')
+      self._lastId += 1
+      job = Job(self._lastId, function, args, kwargs, onDone, onError, onProgress)
+      for kind, olderJob, value in self._events:  # results not yet delivered are stale now
+        olderJob.cancelled = True
+      if self._pending is not None:
+        self._pending.cancelled = True
+      if self._running is not None:
+        self._running.cancelled = True
+      self._pending = job
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._work, name='JobRunner')
+        self._thread.daemon = True
+        self._thread.start()
+      self._wake.notify()
+    return job.id
+
+  def cancel(self):
+    """Cancel the running job, the waiting one and any results not yet delivered."""
+    with self._lock:
+      for kind, job, value in self._events:
+        job.cancelled = True
+      for job in (self._pending, self._running):
+        if job is not None:
+          job.cancelled = True
+      self._pending = None
+
+  @property
+  def busy(self):
+    """True while a job is running or waiting, or there are results not yet delivered by poll()."""
+    with self._lock:
+      return self._pending is not None or self._running is not None or len(self._events) > 0
+
+  def poll(self):
+    """Deliver progress and results on the calling (GUI) thread. Returns busy."""
+    while True:
+      with self._lock:
+        if not self._events:
+          break
+        kind, job, value = self._events.popleft()
+        if kind == 'progress':
+          value, job.progress = job.progress, None
+        if job.cancelled:
+          continue
+      callback = {'progress': job.onProgress, 'done': job.onDone, 'error': job.onError}[kind]
+      if callback is not None:
+        callback(value)
+      elif kind == 'error':
+        logging.error('Background job failed: %s' % value)
+    return self.busy
+
+  def shutdown(self, wait=True):
+    """Cancel everything and stop the worker thread."""
+    self.cancel()
+    with self._lock:
+      self._closed = True
+      self._wake.notify()
+      thread = self._thread
+    if wait and thread is not None:
+      thread.join()
+
+  def _work(self):
+    while True:
+      with self._lock:
+        while self._pending is None and not self._closed:
+          self._wake.wait()
+        if self._closed:
+          return
+        job, self._pending = self._pending, None
+        self._running = job
+
+      def progress(fraction, job=job):
+        with self._lock:
+          if job.cancelled:
+            raise JobCancelled()
+          if job.progress is None:  # one queued progress event per job, with the latest value
+            self._events.append(('progress', job, None))
+          job.progress = fraction
+
+      try:
+        result = job.function(*job.args, progress=progress, **job.kwargs)
+        event = ('done', job, result)
+      except JobCancelled:
+        event = None
+      except Exception as e:
+        event = ('error', job, e)
+
+      with self._lock:
+        if event is not None and not job.cancelled:
+          self._events.append(event)
+        self._running = None